@@ -0,0 +1,452 @@
+# Copyright 2018 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Benchmarks for the requires side of the ceph-rbd-mirror interface.
+
+Drives ``CephRBDMirrorRequires`` through the in-memory relation backend in
+``benchmarks.fake_juju`` at increasing numbers of pools, broker requests and
+ceph-mon units and compares the results with a stored baseline.
+
+Run from the root of the interface::
+
+    python -m benchmarks.bench_requires
+    python -m benchmarks.bench_requires --save-baseline
+
+Timings depend on the machine, so the baseline should be saved on the
+machine the comparison runs on.  A calibration workload is timed along with
+the benchmarks and results are scaled by how much faster or slower it ran
+than when the baseline was saved, and slowdowns below an absolute noise
+floor are not counted as regressions.  Regressions are confirmed by running
+the benchmarks again and comparing the best result of all runs.
+"""
+
+import argparse
+import gc
+import hashlib
+import json
+import os
+import sys
+import time
+
+from benchmarks import bench_import
+from benchmarks.fake_juju import FakeJuju
+
+BASELINE = os.path.join(os.path.dirname(__file__), 'baseline.json')
+# Baseline key holding the time of the calibration workload.
+CALIBRATION = 'calibration'
+# Number of further runs to confirm regressions before reporting them.
+CONFIRM_RUNS = 2
+ENDPOINT = 'ceph-remote'
+UNIQUE_ID = 'rbd-mirror'
+
+POOLS = (1, 100, 1000, 5000)
+BROKER_REQUESTS = (1, 100, 1000)
+MON_UNITS = (1, 3, 5)
+QUICK_POOLS = (1, 100)
+QUICK_BROKER_REQUESTS = (1, 100)
+QUICK_MON_UNITS = (1, 3)
+SITES = (1, 4, 16)
+QUICK_SITES = (1, 4)
+
+
+def pool_ops(count, prefix='pool'):
+    return [{
+        'op': 'create-pool',
+        'name': '{}-{}'.format(prefix, n),
+        'replicas': 3,
+        'pg_num': None,
+        'weight': None,
+        'group': None,
+        'group-namespace': None,
+        'app-name': 'rbd',
+        'max-bytes': None,
+        'max-objects': None,
+    } for n in range(count)]
+
+
+def remote_data(pools=1, broker_requests=1, mon_unit=0):
+    """Build relation data as published by a ceph-mon unit."""
+    return {
+        'auth': 'cephx',
+        '{}_key'.format(UNIQUE_ID): 'AQBtest==',
+        'ceph-public-address': '192.0.2.{}'.format(mon_unit + 1),
+        'ceph-cluster-address': '198.51.100.{}'.format(mon_unit + 1),
+        'pools': {
+            'pool-{}'.format(n): {
+                'applications': {'rbd': {}},
+                'parameters': {'pg_num': 32, 'size': 3},
+            } for n in range(pools)
+        },
+        'broker_requests': [
+            json.dumps({
+                'api-version': 1,
+                'request-id': 'rq-{}'.format(n),
+                'ops': pool_ops(3, prefix='rq-{}'.format(n)),
+            }, sort_keys=True)
+            for n in range(broker_requests)
+        ],
+    }
+
+
+class Scenario(object):
+    """Relation with a number of ceph-mon units publishing data."""
+
+    def __init__(self, juju, pools=1, broker_requests=1, mon_units=3):
+        import requires
+
+        self.juju = juju
+        self.requires = requires
+        self.remote_data = {
+            'ceph-mon/{}'.format(n): remote_data(
+                pools=pools, broker_requests=broker_requests, mon_unit=n)
+            for n in range(mon_units)
+        }
+        self.previous_request = json.dumps({
+            'api-version': 1,
+            'request-id': 'previous',
+            'ops': pool_ops(pools),
+        })
+        self.relation_id = None
+        self.reset()
+
+    def reset(self):
+        """Reset relation data and unit-local storage."""
+        self.juju.reset()
+        self.relation_id = self.juju.add_relation(
+            ENDPOINT, sorted(self.remote_data))
+        for unit, data in self.remote_data.items():
+            self.juju.set_remote_data(self.relation_id, unit, data)
+        self.reset_local_data()
+
+    def reset_local_data(self):
+        """Reset relation data published by the local unit."""
+        self.juju.relation_data[self.relation_id][self.juju.local_unit] = {
+            'broker_req': self.previous_request,
+        }
+
+    def endpoint(self):
+        return self.requires.CephRBDMirrorRequires(
+            ENDPOINT, relation_ids=[self.relation_id], unique_id=UNIQUE_ID)
+
+
+def flush(*endpoints):
+    """Flush data published by endpoints like at the end of a hook."""
+    for endpoint in endpoints:
+        for relation in endpoint.relations:
+            relation._flush_data()
+
+
+def measure(setup, func, repeat):
+    """Get best time of ``func`` over ``repeat`` runs, excluding setup.
+
+    :param setup: Called before each run, the result is passed to ``func``.
+    :type setup: Callable[[], Any]
+    :param func: Function to time.
+    :type func: Callable[[Any], None]
+    :param repeat: Number of runs.
+    :type repeat: int
+    :returns: Best time in seconds.
+    :rtype: float
+    """
+    best = None
+    for _ in range(repeat):
+        state = setup()
+        # like timeit, keep garbage collection out of the measurement
+        gc_enabled = gc.isenabled()
+        gc.disable()
+        try:
+            start = time.perf_counter()
+            func(state)
+            elapsed = time.perf_counter() - start
+        finally:
+            if gc_enabled:
+                gc.enable()
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def calibrate(repeat):
+    """Get best time of a fixed workload over ``repeat`` runs.
+
+    The workload serialises, hashes and parses JSON like the interface does,
+    so its time tracks how fast the machine currently runs the benchmarks.
+
+    :param repeat: Number of runs.
+    :type repeat: int
+    :returns: Best time in seconds.
+    :rtype: float
+    """
+    ops = pool_ops(200)
+
+    def workload(_):
+        for _ in range(20):
+            raw = json.dumps(ops, sort_keys=True)
+            hashlib.sha256(raw.encode('utf-8')).hexdigest()
+            json.loads(raw)
+
+    return measure(lambda: None, workload, repeat)
+
+
+def bench_pools(juju, pools, repeat):
+    scenario = Scenario(juju, pools=pools)
+
+    def setup():
+        scenario.reset_local_data()
+        return scenario.endpoint()
+
+    yield ('create_replicated_pool[pools={}]'.format(pools), measure(
+        setup, lambda ep: ep.create_replicated_pool('new-pool'), repeat))
+    yield ('create_erasure_pool[pools={}]'.format(pools), measure(
+        setup, lambda ep: ep.create_erasure_pool('new-pool'), repeat))
+    yield ('create_pools[pools={},new=100]'.format(pools), measure(
+        setup,
+        lambda ep: ep.create_pools(
+            {'name': 'new-pool-{}'.format(n)} for n in range(100)),
+        repeat))
+
+    rq = scenario.requires.ch_ceph.CephBrokerRq()
+    rq.set_ops(pool_ops(pools, prefix='mirrored'))
+
+    def setup_send():
+        scenario.reset()
+        return scenario.endpoint()
+
+    yield ('maybe_send_rq[ops={}]'.format(pools), measure(
+        setup_send, lambda ep: ep.maybe_send_rq(rq), repeat))
+
+    def setup_unchanged():
+        endpoint = setup_send()
+        endpoint.maybe_send_rq(rq)
+        flush(endpoint)
+        return scenario.endpoint()
+
+    yield ('maybe_send_rq_unchanged[ops={}]'.format(pools), measure(
+        setup_unchanged, lambda ep: ep.maybe_send_rq(rq), repeat))
+
+
+def bench_broker_requests(juju, broker_requests, repeat):
+    scenario = Scenario(juju, broker_requests=broker_requests)
+
+    def iterate(ep):
+        # the rbd-mirror charm iterates the broker requests several times
+        for _ in range(3):
+            for rq in ep.broker_requests:
+                pass
+
+    yield ('broker_requests[requests={}]'.format(broker_requests), measure(
+        scenario.endpoint, iterate, repeat))
+
+
+def bench_mon_units(juju, mon_units, repeat):
+    scenario = Scenario(juju, pools=100, broker_requests=100,
+                        mon_units=mon_units)
+
+    def render(ep):
+        # templates typically read the mon hosts several times
+        for _ in range(3):
+            list(ep.mon_hosts())
+
+    yield ('mon_hosts[units={}]'.format(mon_units), measure(
+        scenario.endpoint, render, repeat))
+    yield ('changed[units={}]'.format(mon_units), measure(
+        scenario.endpoint, lambda ep: ep.changed(), repeat))
+
+    def setup_hook():
+        scenario.reset()
+        return scenario.requires.CephRBDMirrorRequires
+
+    yield ('hook[units={}]'.format(mon_units), measure(
+        setup_hook,
+        lambda endpoint_class: juju.run_hook(
+            endpoint_class, ENDPOINT, relation_id=scenario.relation_id,
+            unique_id=UNIQUE_ID),
+        repeat))
+
+
+def bench_fan_out(juju, sites, repeat):
+    import requires
+
+    juju.reset()
+    source_id = juju.add_relation(ENDPOINT, ['ceph-mon/0'])
+    juju.set_remote_data(source_id, 'ceph-mon/0',
+                         remote_data(broker_requests=100))
+    site_ids = {}
+    for n in range(sites):
+        endpoint_name = 'ceph-site-{}'.format(n)
+        site_ids[endpoint_name] = juju.add_relation(
+            endpoint_name, ['ceph-mon/0'])
+        juju.set_remote_data(site_ids[endpoint_name], 'ceph-mon/0',
+                             remote_data())
+
+    def endpoints():
+        return (
+            requires.CephRBDMirrorRequires(
+                ENDPOINT, relation_ids=[source_id], unique_id=UNIQUE_ID),
+            [requires.CephRBDMirrorRequires(
+                endpoint_name, relation_ids=[relation_id],
+                unique_id=UNIQUE_ID)
+             for endpoint_name, relation_id in sorted(site_ids.items())])
+
+    def setup():
+        import charmhelpers.core.unitdata as unitdata
+
+        unitdata._KV = unitdata.Storage(':memory:')
+        for relation_id in site_ids.values():
+            juju.relation_data[relation_id][juju.local_unit] = {}
+        return endpoints()
+
+    def fan_out(state):
+        source, targets = state
+        requires.fan_out_broker_requests(source, targets)
+
+    def setup_unchanged():
+        state = setup()
+        fan_out(state)
+        flush(*state[1])
+        return endpoints()
+
+    yield ('fan_out[sites={}]'.format(sites), measure(
+        setup, fan_out, repeat))
+    yield ('fan_out_unchanged[sites={}]'.format(sites), measure(
+        setup_unchanged, fan_out, repeat))
+
+
+def run(quick=False, repeat=5):
+    """Run benchmarks.
+
+    :param quick: Only run the smaller scenarios.
+    :type quick: bool
+    :param repeat: Number of runs for each benchmark.
+    :type repeat: int
+    :returns: Best time in seconds keyed by benchmark name.
+    :rtype: Dict[str, float]
+    """
+    results = {}
+    with FakeJuju([ENDPOINT]) as juju:
+        for pools in (QUICK_POOLS if quick else POOLS):
+            results.update(bench_pools(juju, pools, repeat))
+        for broker_requests in (QUICK_BROKER_REQUESTS if quick
+                                else BROKER_REQUESTS):
+            results.update(bench_broker_requests(
+                juju, broker_requests, repeat))
+        for mon_units in (QUICK_MON_UNITS if quick else MON_UNITS):
+            results.update(bench_mon_units(juju, mon_units, repeat))
+        for sites in (QUICK_SITES if quick else SITES):
+            results.update(bench_fan_out(juju, sites, repeat))
+    results.update(bench_import.run(repeat=repeat))
+    return results
+
+
+def compare(results, baseline, tolerance, min_delta=0.0, scale=1.0,
+            verbose=True):
+    """Compare results with baseline.
+
+    :param results: Best time in seconds keyed by benchmark name.
+    :type results: Dict[str, float]
+    :param baseline: Best time in seconds keyed by benchmark name.
+    :type baseline: Dict[str, float]
+    :param tolerance: Allowed slowdown, 0.5 allows results to take 50%
+                      longer than the baseline.
+    :type tolerance: float
+    :param min_delta: Slowdown in seconds below which a result never counts
+                      as a regression.
+    :type min_delta: float
+    :param scale: Factor applied to baseline times, see ``calibrate``.
+    :type scale: float
+    :param verbose: Print the result of each benchmark.
+    :type verbose: bool
+    :returns: Names of benchmarks that regressed.
+    :rtype: List[str]
+    """
+    regressions = []
+    for name, elapsed in results.items():
+        reference = baseline.get(name)
+        if reference:
+            reference *= scale
+            ratio = elapsed / reference
+            status = 'ok'
+            if ratio > 1 + tolerance and elapsed - reference > min_delta:
+                status = 'REGRESSION'
+            if status != 'ok':
+                regressions.append(name)
+            if verbose:
+                print('{:<45} {:>12.6f}s {:>8.2f}x  {}'.format(
+                    name, elapsed, ratio, status))
+        elif verbose:
+            print('{:<45} {:>12.6f}s {:>9}  new'.format(name, elapsed, '-'))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--baseline', default=BASELINE,
+                        help='baseline file (default: %(default)s)')
+    parser.add_argument('--save-baseline', action='store_true',
+                        help='store results as the new baseline')
+    parser.add_argument('--tolerance', type=float, default=0.5,
+                        help='allowed slowdown before a result counts as a '
+                             'regression (default: %(default)s)')
+    parser.add_argument('--min-delta', type=float, default=0.0001,
+                        help='slowdown in seconds below which a result does '
+                             'not count as a regression (default: '
+                             '%(default)s)')
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='runs per benchmark (default: %(default)s)')
+    parser.add_argument('--quick', action='store_true',
+                        help='only run the smaller scenarios')
+    args = parser.parse_args(argv)
+
+    calibration = calibrate(args.repeat)
+    results = run(quick=args.quick, repeat=args.repeat)
+    calibration = min(calibration, calibrate(args.repeat))
+    if args.save_baseline:
+        with open(args.baseline, 'w') as baseline_file:
+            json.dump(dict(results, **{CALIBRATION: calibration}),
+                      baseline_file, indent=4, sort_keys=True)
+            baseline_file.write('\n')
+        compare(results, {}, args.tolerance)
+        return 0
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+    reference = baseline.pop(CALIBRATION, None)
+    scale = calibration / reference if reference else 1.0
+    for _ in range(CONFIRM_RUNS):
+        if not compare(results, baseline, args.tolerance,
+                       min_delta=args.min_delta, scale=scale, verbose=False):
+            break
+        # the machine may have been busy for part of the run, confirm with
+        # the best results of another run
+        print('re-running benchmarks to confirm regressions')
+        calibration = min(calibration, calibrate(args.repeat))
+        for name, elapsed in run(quick=args.quick,
+                                 repeat=args.repeat).items():
+            results[name] = min(results.get(name, elapsed), elapsed)
+        scale = calibration / reference if reference else 1.0
+    if reference:
+        print('calibration {:.6f}s, baseline scaled by {:.2f}x'.format(
+            calibration, scale))
+    regressions = compare(results, baseline, args.tolerance,
+                          min_delta=args.min_delta, scale=scale)
+    if regressions:
+        print('{} benchmark(s) regressed by more than {:.0%}'.format(
+            len(regressions), args.tolerance))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,339 @@
+# Copyright 2018 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""In-memory stand-in for the Juju hook tools used by this interface.
+
+Patches the relation hook tools used by ``charms.reactive`` and
+``charmhelpers.contrib.storage.linux.ceph`` and replaces unit-local storage
+with an in-memory database so ``CephRBDMirrorRequires`` can be driven without
+a Juju controller.  Relation data, ``Endpoint.relations``, ``to_publish``,
+``received``, reactive flags and the charm-helpers broker request helpers all
+run unmodified on top of it.
+
+Relation data can be saved to and loaded from recordings, which are JSON
+documents of the form::
+
+    {
+        "local_unit": "ceph-rbd-mirror/0",
+        "unique_id": "juju-1a2b3c-0",
+        "relations": {
+            "ceph-remote:1": {
+                "endpoint": "ceph-remote",
+                "units": {
+                    "ceph-mon/0": {"auth": "cephx", ...},
+                    "ceph-rbd-mirror/0": {"broker_req": "...", ...}
+                }
+            }
+        }
+    }
+
+where unit data holds the raw string values as shown by ``relation-get``.
+"""
+
+import collections
+import json
+import os
+import shutil
+import sys
+import tempfile
+
+from pathlib import Path
+from unittest import mock
+
+INTERFACE_DIR = Path(__file__).resolve().parent.parent
+
+
+class FakeJuju(object):
+    """Fake relation backend.
+
+    Must be started before ``requires`` is imported, as the reactive
+    decorators look up endpoint names in the charm metadata at import time.
+
+    Usage::
+
+        with FakeJuju(['ceph-remote']) as juju:
+            rid = juju.add_relation('ceph-remote', ['ceph-mon/0'])
+            juju.set_remote_data(rid, 'ceph-mon/0', {'auth': 'cephx'})
+            import requires
+            endpoint = juju.run_hook(requires.CephRBDMirrorRequires,
+                                     'ceph-remote', relation_id=rid)
+    """
+
+    def __init__(self, endpoint_names=('ceph-local', 'ceph-remote'),
+                 local_unit='ceph-rbd-mirror/0', ceph_tools=True):
+        self.endpoint_names = list(endpoint_names)
+        self.local_unit = local_unit
+        # install the fake hook tools in the charm-helpers ceph module too,
+        # which imports it
+        self.ceph_tools = ceph_tools
+        # relation data keyed by relation ID and then unit name, the local
+        # unit included
+        self.relation_data = {}
+        # number of calls to each hook tool
+        self.calls = collections.Counter()
+        self._relation_types = {}
+        self._next_relation_id = 0
+        self._hook = {'hook_name': None, 'relation_id': None,
+                      'remote_unit': None}
+        self._patchers = []
+        self._charm_dir = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def start(self):
+        """Install fake hook tools and unit-local storage."""
+        import charmhelpers.core.hookenv as hookenv
+        import charmhelpers.core.unitdata as unitdata
+
+        self._charm_dir = tempfile.mkdtemp(prefix='fake-juju-')
+        with open(os.path.join(self._charm_dir, 'metadata.yaml'), 'w') as md:
+            md.write('name: ceph-rbd-mirror\nrequires:\n')
+            for endpoint_name in self.endpoint_names:
+                md.write('  {}:\n    interface: {}\n'.format(
+                    endpoint_name, INTERFACE_DIR.name))
+        self._patch(mock.patch.dict(os.environ, {
+            'CHARM_DIR': self._charm_dir,
+            'JUJU_UNIT_NAME': self.local_unit,
+        }))
+        self._patch(mock.patch.object(
+            unitdata, '_KV', unitdata.Storage(':memory:')))
+        hookenv.cache.clear()
+        tools = {
+            'hook_name': lambda: self._hook['hook_name'],
+            'local_unit': lambda: self.local_unit,
+            'log': self.log,
+            'relation_get': self.relation_get,
+            'relation_id': lambda *args, **kwargs: self._hook['relation_id'],
+            'relation_ids': self.relation_ids,
+            'relation_set': self.relation_set,
+            'related_units': self.related_units,
+            'remote_unit': lambda: self._hook['remote_unit'],
+        }
+        modules = [hookenv]
+        if self.ceph_tools:
+            try:
+                import charmhelpers.contrib.storage.linux.ceph as ch_ceph
+                modules.append(ch_ceph)
+            except ImportError:
+                pass
+        for module in modules:
+            for name, tool in tools.items():
+                if hasattr(module, name):
+                    self._patch(mock.patch.object(module, name, tool))
+
+    def stop(self):
+        """Remove fake hook tools and unit-local storage."""
+        while self._patchers:
+            self._patchers.pop().stop()
+        if self._charm_dir:
+            shutil.rmtree(self._charm_dir, ignore_errors=True)
+            self._charm_dir = None
+
+    def reset(self):
+        """Remove all relations and empty unit-local storage."""
+        import charmhelpers.core.unitdata as unitdata
+
+        self.relation_data.clear()
+        self._relation_types.clear()
+        self._next_relation_id = 0
+        unitdata._KV = unitdata.Storage(':memory:')
+
+    def _patch(self, patcher):
+        patcher.start()
+        self._patchers.append(patcher)
+
+    def add_relation(self, endpoint_name, remote_units, relation_id=None):
+        """Add relation with remote units to endpoint.
+
+        :param endpoint_name: Name of endpoint.
+        :type endpoint_name: str
+        :param remote_units: Names of remote units.
+        :type remote_units: List[str]
+        :param relation_id: Relation ID, generated if not provided.
+        :type relation_id: Optional[str]
+        :returns: Relation ID
+        :rtype: str
+        """
+        if relation_id is None:
+            relation_id = '{}:{}'.format(endpoint_name,
+                                         self._next_relation_id)
+            self._next_relation_id += 1
+        self._relation_types[relation_id] = endpoint_name
+        self.relation_data[relation_id] = {self.local_unit: {}}
+        for unit in remote_units:
+            self.relation_data[relation_id][unit] = {}
+        return relation_id
+
+    def set_remote_data(self, relation_id, unit, data):
+        """Replace relation data of remote unit.
+
+        Values that are not strings are JSON encoded, like the ceph-mon
+        does.
+
+        :param relation_id: Relation ID.
+        :type relation_id: str
+        :param unit: Name of remote unit.
+        :type unit: str
+        :param data: Relation data.
+        :type data: Dict[str, Any]
+        """
+        self.relation_data[relation_id][unit] = {
+            key: value if isinstance(value, str) else json.dumps(value)
+            for key, value in data.items()
+        }
+
+    def load(self, recording):
+        """Replace all relation data with recorded relation data.
+
+        :param recording: Recording, see module documentation.
+        :type recording: Dict[str, Any]
+        """
+        self.reset()
+        self.local_unit = recording.get('local_unit', self.local_unit)
+        for relation_id, relation in recording['relations'].items():
+            self.add_relation(relation['endpoint'], [],
+                              relation_id=relation_id)
+            for unit, data in relation['units'].items():
+                self.relation_data[relation_id][unit] = dict(data)
+
+    def dump(self):
+        """Get recording of current relation data.
+
+        :returns: Recording, see module documentation.
+        :rtype: Dict[str, Any]
+        """
+        return {
+            'local_unit': self.local_unit,
+            'relations': {
+                relation_id: {
+                    'endpoint': self._relation_types[relation_id],
+                    'units': {
+                        unit: dict(data) for unit, data in units.items()},
+                } for relation_id, units in self.relation_data.items()
+            },
+        }
+
+    def run_hook(self, endpoint_class, endpoint_name, relation_id=None,
+                 remote_unit=None, hook='changed', handler=None, **kwargs):
+        """Simulate a hook run for an endpoint.
+
+        State the interface module shares between endpoints for the duration
+        of a hook is reset first, as each hook would run in a new process.
+        Like the reactive framework the endpoint is constructed, its
+        automatic flags are managed, its handlers are dispatched according
+        to the flags set, published data is flushed to the relation and
+        unit-local storage is committed.
+
+        :param endpoint_class: Endpoint class to construct.
+        :type endpoint_class: Type[charms.reactive.Endpoint]
+        :param endpoint_name: Name of endpoint.
+        :type endpoint_name: str
+        :param relation_id: Relation the hook runs for, None for a hook that
+                            is not a relation hook such as update-status.
+        :type relation_id: Optional[str]
+        :param remote_unit: Remote unit the hook runs for.
+        :type remote_unit: Optional[str]
+        :param hook: Relation hook kind, such as ``joined`` or ``changed``,
+                     or the full hook name when ``relation_id`` is None.
+        :type hook: str
+        :param handler: Called with the endpoint after the interface
+                        handlers, for example to run charm code.
+        :type handler: Optional[Callable[[charms.reactive.Endpoint], None]]
+        :param kwargs: Passed on to the endpoint constructor.
+        :returns: The endpoint.
+        :rtype: charms.reactive.Endpoint
+        """
+        import charmhelpers.core.hookenv as hookenv
+        import charmhelpers.core.unitdata as unitdata
+        from charms.reactive.flags import is_flag_set
+
+        if relation_id:
+            hook = '{}-relation-{}'.format(
+                self._relation_types[relation_id], hook)
+            if remote_unit is None:
+                remote_unit = next(iter(self.related_units(relation_id)),
+                                   None)
+        self._hook.update(hook_name=hook, relation_id=relation_id,
+                          remote_unit=remote_unit)
+        hookenv.cache.clear()
+        reset_hook_state = getattr(sys.modules[endpoint_class.__module__],
+                                   '_reset_hook_state', None)
+        if reset_hook_state:
+            reset_hook_state()
+        try:
+            endpoint = endpoint_class(
+                endpoint_name,
+                relation_ids=self.relation_ids(endpoint_name),
+                **kwargs)
+            endpoint._manage_departed()
+            endpoint._manage_flags()
+            joined = endpoint.expand_name('endpoint.{endpoint_name}.joined')
+            if is_flag_set(joined):
+                endpoint.joined()
+                if is_flag_set(endpoint.expand_name(
+                        'endpoint.{endpoint_name}.changed')):
+                    endpoint.changed()
+            else:
+                endpoint.broken()
+            if handler:
+                handler(endpoint)
+            for relation in endpoint.relations:
+                relation._flush_data()
+            unitdata.kv().flush()
+        finally:
+            self._hook.update(hook_name=None, relation_id=None,
+                              remote_unit=None)
+        return endpoint
+
+    def log(self, message, level=None):
+        self.calls['log'] += 1
+
+    def relation_ids(self, reltype=None):
+        self.calls['relation_ids'] += 1
+        return sorted(
+            relation_id
+            for relation_id, endpoint_name in self._relation_types.items()
+            if reltype is None or endpoint_name == reltype)
+
+    def related_units(self, relid=None):
+        self.calls['related_units'] += 1
+        return sorted(
+            unit for unit in self.relation_data.get(relid, {})
+            if unit != self.local_unit)
+
+    def relation_get(self, attribute=None, unit=None, rid=None, app=None):
+        self.calls['relation_get'] += 1
+        data = self.relation_data.get(rid, {}).get(unit or self.local_unit)
+        if data is None:
+            return None
+        if attribute is None:
+            return dict(data)
+        return data.get(attribute)
+
+    def relation_set(self, relation_id=None, relation_settings=None,
+                     app=False, **kwargs):
+        self.calls['relation_set'] += 1
+        settings = dict(relation_settings or {})
+        settings.update(kwargs)
+        data = self.relation_data[relation_id][self.local_unit]
+        for key, value in settings.items():
+            if value is None or value == '':
+                data.pop(key, None)
+            else:
+                data[key] = str(value)
@@ -0,0 +1,186 @@
+# Copyright 2018 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Replay relation data through the requires endpoint to profile hooks.
+
+Loads a recording of relation data, see ``benchmarks.fake_juju``, or builds
+a synthetic one, and runs simulated hooks for an endpoint of the interface
+over and over to measure hook latency.
+
+Run from the root of the interface::
+
+    python -m benchmarks.replay --hooks 10000 recording.json
+    python -m benchmarks.replay --pools 5000 --profile hooks.prof
+"""
+
+import argparse
+import cProfile
+import json
+import pstats
+import statistics
+import sys
+import time
+
+from benchmarks import bench_requires
+from benchmarks.fake_juju import FakeJuju
+
+
+def synthetic_recording(pools, broker_requests, mon_units):
+    """Build recording of relation data with one ceph-mon relation.
+
+    :returns: Recording, see ``benchmarks.fake_juju``.
+    :rtype: Dict[str, Any]
+    """
+    units = {
+        'ceph-mon/{}'.format(n): {
+            key: value if isinstance(value, str) else json.dumps(value)
+            for key, value in bench_requires.remote_data(
+                pools=pools, broker_requests=broker_requests,
+                mon_unit=n).items()
+        } for n in range(mon_units)
+    }
+    units['ceph-rbd-mirror/0'] = {}
+    return {
+        'local_unit': 'ceph-rbd-mirror/0',
+        'unique_id': bench_requires.UNIQUE_ID,
+        'relations': {
+            '{}:1'.format(bench_requires.ENDPOINT): {
+                'endpoint': bench_requires.ENDPOINT,
+                'units': units,
+            },
+        },
+    }
+
+
+def collapse_broker_requests(endpoint):
+    """Collapse all received broker requests like the rbd-mirror charm.
+
+    The ops are sent back on the same endpoint, which keeps the replay
+    self-contained while exercising the same code paths.
+    """
+    import requires
+
+    requires.fan_out_broker_requests(endpoint, [endpoint])
+
+
+def replay(recording, hooks, endpoint_name=None, hook='changed',
+           fresh=False, handler=None):
+    """Run simulated hooks over recorded relation data.
+
+    :param recording: Recording, see ``benchmarks.fake_juju``.
+    :type recording: Dict[str, Any]
+    :param hooks: Number of hooks to run.
+    :type hooks: int
+    :param endpoint_name: Endpoint to run hooks for, defaults to the
+                          endpoint of the first recorded relation.
+    :type endpoint_name: Optional[str]
+    :param hook: Relation hook kind to simulate.
+    :type hook: str
+    :param fresh: Load the recording again before every hook, otherwise
+                  state carries over between hooks as in a deployment.
+    :type fresh: bool
+    :param handler: Called with the endpoint in every hook.
+    :type handler: Optional[Callable[[charms.reactive.Endpoint], None]]
+    :returns: Duration of every hook in seconds and number of calls to each
+              hook tool.
+    :rtype: Tuple[List[float], Dict[str, int]]
+    """
+    relations = recording['relations']
+    if endpoint_name is None:
+        endpoint_name = next(iter(relations.values()))['endpoint']
+    relation_id = next(
+        relation_id for relation_id, relation in relations.items()
+        if relation['endpoint'] == endpoint_name)
+    endpoint_names = sorted(set(
+        relation['endpoint'] for relation in relations.values()))
+    durations = []
+    with FakeJuju(endpoint_names) as juju:
+        import requires
+
+        juju.load(recording)
+        for _ in range(hooks):
+            if fresh:
+                juju.load(recording)
+            start = time.perf_counter()
+            juju.run_hook(requires.CephRBDMirrorRequires, endpoint_name,
+                          relation_id=relation_id, hook=hook,
+                          handler=handler,
+                          unique_id=recording.get('unique_id'))
+            durations.append(time.perf_counter() - start)
+        calls = dict(juju.calls)
+    return durations, calls
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('recording', nargs='?',
+                        help='recording of relation data, a synthetic '
+                             'recording is used when not provided')
+    parser.add_argument('--endpoint', help='endpoint to run hooks for')
+    parser.add_argument('--hook', default='changed',
+                        help='relation hook kind (default: %(default)s)')
+    parser.add_argument('--hooks', type=int, default=1000,
+                        help='number of hooks to run (default: %(default)s)')
+    parser.add_argument('--fresh', action='store_true',
+                        help='load the recording again before every hook')
+    parser.add_argument('--collapse', action='store_true',
+                        help='collapse received broker requests and send '
+                             'them in every hook like the rbd-mirror charm')
+    parser.add_argument('--pools', type=int, default=100,
+                        help='pools in synthetic recording')
+    parser.add_argument('--broker-requests', type=int, default=100,
+                        help='broker requests in synthetic recording')
+    parser.add_argument('--mon-units', type=int, default=3,
+                        help='ceph-mon units in synthetic recording')
+    parser.add_argument('--profile', metavar='FILE',
+                        help='profile the hooks and save stats to FILE')
+    args = parser.parse_args(argv)
+
+    if args.recording:
+        with open(args.recording) as recording_file:
+            recording = json.load(recording_file)
+    else:
+        recording = synthetic_recording(args.pools, args.broker_requests,
+                                        args.mon_units)
+    kwargs = {
+        'endpoint_name': args.endpoint,
+        'hook': args.hook,
+        'fresh': args.fresh,
+        'handler': collapse_broker_requests if args.collapse else None,
+    }
+    if args.profile:
+        profile = cProfile.Profile()
+        durations, calls = profile.runcall(replay, recording, args.hooks,
+                                           **kwargs)
+        profile.dump_stats(args.profile)
+        pstats.Stats(profile).sort_stats('cumulative').print_stats(20)
+    else:
+        durations, calls = replay(recording, args.hooks, **kwargs)
+
+    durations.sort()
+    print('hooks:       {}'.format(len(durations)))
+    print('hooks/s:     {:.1f}'.format(len(durations) / sum(durations)))
+    print('mean:        {:.6f}s'.format(statistics.mean(durations)))
+    print('p50:         {:.6f}s'.format(durations[len(durations) // 2]))
+    print('p95:         {:.6f}s'.format(
+        durations[int(len(durations) * 0.95)]))
+    print('max:         {:.6f}s'.format(durations[-1]))
+    for tool, count in sorted(calls.items()):
+        print('{:<12} {:.1f} per hook'.format(
+            tool + ':', count / len(durations)))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -12,12 +12,20 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import base64
+import collections
+import contextlib
+import hashlib
+import importlib
 import ipaddress
 import json
+import queue
+import re
 import socket
+import threading
+import time
 import uuid
-
-from netaddr.core import AddrFormatError
+import zlib
 
 # the reactive framework unfortunately does not grok `import as` in conjunction
 # with decorators on class instance methods, so we have to revert to `from ...`
@@ -26,13 +34,295 @@ from charms.reactive import (
     Endpoint,
     all_flags_set,
     clear_flag,
+    get_flags,
     set_flag,
     when,
     when_not,
 )
 
-import charmhelpers.contrib.storage.linux.ceph as ch_ceph
-import charmhelpers.contrib.network.ip as ch_ip
+import charmhelpers.core.hookenv as ch_hookenv
+import charmhelpers.core.unitdata as ch_unitdata
+
+
+class _LazyModule(object):
+    """Module imported on first attribute access.
+
+    Attributes are set on and deleted from the module itself, so they can be
+    patched as on the module.
+    """
+
+    def __init__(self, name):
+        object.__setattr__(self, '_name', name)
+        object.__setattr__(self, '_module', None)
+
+    def _load(self):
+        if self._module is None:
+            object.__setattr__(self, '_module',
+                               importlib.import_module(self._name))
+        return self._module
+
+    def __getattr__(self, name):
+        return getattr(self._load(), name)
+
+    def __setattr__(self, name, value):
+        setattr(self._load(), name, value)
+
+    def __delattr__(self, name):
+        delattr(self._load(), name)
+
+
+# Only hooks that talk to Ceph or inspect networks need these, and importing
+# them takes a substantial part of the time spent loading the interface.
+ch_ceph = _LazyModule('charmhelpers.contrib.storage.linux.ceph')
+ch_ip = _LazyModule('charmhelpers.contrib.network.ip')
+netaddr_core = _LazyModule('netaddr.core')
+
+# Default ports of the Ceph messenger v1 and v2 protocols
+MSGR1_PORT = 6789
+MSGR2_PORT = 3300
+
+# Compact encoding of broker requests, zlib compressed and base64 encoded
+# canonical JSON.  Encoded values are prefixed so they can be told apart from
+# plain JSON.
+COMPACT_ENCODING = 'zlib+b64'
+_COMPACT_PREFIX = COMPACT_ENCODING + ':'
+
+# Content defined chunking of broker requests.  A chunk ends after an op whose
+# digest is a multiple of CHUNK_AVERAGE_OPS, or once it holds CHUNK_MAX_OPS
+# ops, so adding or removing an op only changes the chunk holding it.
+CHUNKED_REQUESTS = 'broker-req-chunks'
+CHUNK_AVERAGE_OPS = 32
+CHUNK_MAX_OPS = 128
+
+# Index of pools known by the ceph-mon, see
+# ``CephRBDMirrorRequires.pool_index``
+PoolIndex = collections.namedtuple('PoolIndex', ['by_name', 'by_app',
+                                                 'by_type'])
+
+# Network CIDR for addresses advertised on the relation.  Resolving an address
+# enumerates all local interfaces, so results are shared between properties
+# and endpoint instances for the duration of the hook.
+_network_cidrs = {}
+
+
+def _resolve_network_cidr(addr, metrics=None):
+    """Resolve CIDR of local network for address, caching the result.
+
+    :param addr: Address to resolve network for.
+    :type addr: str
+    :param metrics: Record resolution in these metrics.
+    :type metrics: Optional[HookMetrics]
+    :returns: CIDR or None
+    :rtype: Option[str, None]
+    """
+    if addr not in _network_cidrs:
+        try:
+            if metrics is None:
+                _network_cidrs[addr] = ch_ip.resolve_network_cidr(addr)
+            else:
+                _network_cidrs[addr] = metrics.call(
+                    'resolve_network_cidr', ch_ip.resolve_network_cidr, addr)
+        except netaddr_core.AddrFormatError:
+            # LP#1898299 in some cases the netmask will be None, which
+            # leads to an AddrFormatError. In this case, we should return
+            # None
+            _network_cidrs[addr] = None
+    return _network_cidrs[addr]
+
+
+# Hostnames advertised on the relation are resolved concurrently, and all
+# lookups of a hook share a deadline so one slow or unreachable name server
+# can not stall the hook.  Results are cached in unit-local storage, failed
+# lookups for a shorter time.
+RESOLVE_TIMEOUT = 5
+RESOLVE_TTL = 300
+RESOLVE_NEGATIVE_TTL = 30
+RESOLVE_WORKERS = 8
+
+_HOSTNAME_RE = re.compile(
+    r'^(?=.{1,253}\.?$)[A-Za-z0-9]([A-Za-z0-9-]{0,61}[A-Za-z0-9])?'
+    r'(\.[A-Za-z0-9]([A-Za-z0-9-]{0,61}[A-Za-z0-9])?)*\.?$')
+
+# Addresses of hostnames resolved in this hook and the deadline for lookups.
+_resolved_hosts = {}
+_resolve_deadline = None
+
+# Hostname of the unit, the default unique ID of endpoints.
+_hostname = None
+
+
+def _reset_hook_state():
+    """Reset state shared by endpoints for the duration of a hook.
+
+    Every hook runs in a new process, this is for running several hooks in
+    one process such as the hook simulation in ``benchmarks.fake_juju``.
+    """
+    global _resolve_deadline, _hostname
+    _network_cidrs.clear()
+    _resolved_hosts.clear()
+    _resolve_deadline = None
+    _hostname = None
+
+
+def _resolve_hostname(host):
+    """Resolve hostname to address.
+
+    :param host: Hostname to resolve.
+    :type host: str
+    :returns: Address or None
+    :rtype: Optional[str]
+    """
+    try:
+        infos = socket.getaddrinfo(host, None, 0, socket.SOCK_STREAM)
+    except (socket.gaierror, UnicodeError):
+        return None
+    # drop the scope of IPv6 link-local addresses
+    return infos[0][4][0].split('%')[0] if infos else None
+
+
+def _resolve_hostnames(hosts):
+    """Resolve hostnames concurrently within the deadline of the hook.
+
+    Lookups run in a pool of daemon threads, lookups not done when the
+    deadline passes are abandoned and delay neither the hook nor its exit.
+
+    :param hosts: Hostnames to resolve.
+    :type hosts: List[str]
+    :returns: Address or None for each hostname resolved before the deadline.
+    :rtype: Dict[str, Optional[str]]
+    """
+    global _resolve_deadline
+    if _resolve_deadline is None:
+        _resolve_deadline = time.monotonic() + RESOLVE_TIMEOUT
+    work = queue.Queue()
+    for host in hosts:
+        work.put(host)
+    results = queue.Queue()
+
+    def worker():
+        while True:
+            try:
+                host = work.get_nowait()
+            except queue.Empty:
+                return
+            results.put((host, _resolve_hostname(host)))
+
+    for _ in range(min(RESOLVE_WORKERS, len(hosts))):
+        threading.Thread(target=worker, daemon=True).start()
+    resolved = {}
+    while len(resolved) < len(hosts):
+        remaining = _resolve_deadline - time.monotonic()
+        if remaining <= 0:
+            break
+        try:
+            host, addr = results.get(timeout=remaining)
+        except queue.Empty:
+            break
+        resolved[host] = addr
+    return resolved
+
+
+def _encode_compact(data):
+    """Encode data as compressed and base64 encoded canonical JSON.
+
+    :param data: JSON serializable data.
+    :type data: Any
+    :returns: Encoded data.
+    :rtype: str
+    """
+    canonical = json.dumps(data, sort_keys=True, separators=(',', ':'))
+    return _COMPACT_PREFIX + base64.b64encode(
+        zlib.compress(canonical.encode('utf-8'))).decode('ascii')
+
+
+def _unpack(raw):
+    """Get JSON from raw relation data, which may be compact encoded.
+
+    :param raw: Plain or compact encoded JSON.
+    :type raw: str
+    :returns: Plain JSON.
+    :rtype: str
+    """
+    if raw.startswith(_COMPACT_PREFIX):
+        return zlib.decompress(
+            base64.b64decode(raw[len(_COMPACT_PREFIX):])).decode('utf-8')
+    return raw
+
+
+def _chunk_ops(ops, average=CHUNK_AVERAGE_OPS, maximum=CHUNK_MAX_OPS):
+    """Split broker request operations in content defined chunks.
+
+    :param ops: Broker request operations.
+    :type ops: List[Dict[str, Any]]
+    :param average: Average number of operations in a chunk.
+    :type average: int
+    :param maximum: Maximum number of operations in a chunk.
+    :type maximum: int
+    :returns: Chunk id and operations for each chunk, in order.
+    :rtype: List[Tuple[str, List[Dict[str, Any]]]]
+    """
+    chunks = []
+    chunk = []
+    for op in ops:
+        chunk.append(op)
+        digest = hashlib.sha256(
+            json.dumps(op, sort_keys=True).encode('utf-8')).hexdigest()
+        if int(digest[:8], 16) % average == 0 or len(chunk) >= maximum:
+            chunks.append(chunk)
+            chunk = []
+    if chunk:
+        chunks.append(chunk)
+    return [
+        (hashlib.sha256(json.dumps(chunk, sort_keys=True).encode(
+            'utf-8')).hexdigest()[:16], chunk)
+        for chunk in chunks]
+
+
+def _ops_digest(ops):
+    """Get digest of broker request operations.
+
+    :param ops: Broker request operations.
+    :type ops: List[Dict[str, Any]]
+    :rtype: str
+    """
+    return hashlib.sha256(
+        json.dumps(ops, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+class HookMetrics(object):
+    """Counts and durations of hot-path calls made during a hook."""
+
+    def __init__(self):
+        self.counts = collections.Counter()
+        self.durations = collections.Counter()
+
+    def call(self, name, func, *args, **kwargs):
+        """Call function and record count and duration of the call.
+
+        :param name: Name to record call under.
+        :type name: str
+        :param func: Function to call.
+        :type func: Callable
+        :returns: Result of the call.
+        :rtype: Any
+        """
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            self.durations[name] += time.perf_counter() - start
+            self.counts[name] += 1
+
+    def summary(self):
+        """Get summary of recorded calls.
+
+        :returns: Number of calls and total duration in seconds keyed by name.
+        :rtype: Dict[str, Dict[str, Union[int, float]]]
+        """
+        return {
+            name: {'count': count, 'seconds': self.durations[name]}
+            for name, count in sorted(self.counts.items())
+        }
 
 
 class CephRBDMirrorRequires(Endpoint):
@@ -44,19 +334,92 @@ class CephRBDMirrorRequires(Endpoint):
 
         The unique_id constructor parameter exists mainly for testing purposes.
         """
-        if unique_id:
-            self.unique_id = unique_id
-        else:
-            self.unique_id = socket.gethostname()
-        self.key_name = '{}_key'.format(self.unique_id)
+        self._unique_id = unique_id or None
+        self._key_name = None
+        # Hook scoped caches of previous broker request and index of its
+        # operations per relation, see ``_previous_request`` and
+        # ``_op_index``.
+        self._previous_requests = {}
+        self._op_indexes = {}
+        # Decoded broker requests received from the remote end keyed by digest
+        # of their raw JSON string, and the decoded requests of the hook, see
+        # ``_decode_broker_requests``.
+        self._broker_request_cache = {}
+        self._broker_requests = None
+        self._broker_requests_by_id = {}
+        self._broker_requests_delta = None
+        # Digests of operations in broker requests sent per relation,
+        # persisted in unit-local storage, see ``maybe_send_rq``.
+        self._sent_digests = None
+        # Parsed addresses of related ceph-mon units and the raw addresses
+        # they were parsed from, see ``_mon_addresses``.
+        self._mon_addrs = []
+        self._mon_addrs_raw = None
+        # Pool map merged from deltas published by the ceph-mon, see
+        # ``_merge_pools_delta``.
+        self._merged_pools = None
+        self._pool_index = None
+        # Instrumentation of hot-path calls, see ``enable_metrics``.
+        self.metrics = None
+        # Nesting depth of ``batch_publish``, broker request to send and sent
+        # digests to record when the outermost batch ends.
+        self._batch_depth = 0
+        self._pending_request = None
+        self._pending_digests = []
+        # Key material received in this hook and as recorded in unit-local
+        # storage, see ``_get_key_material``.
+        self._key_material = None
+        self._key_record = None
+        # Whether compact encoding is enabled, see ``enable_compact_encoding``
+        self._compact_encoding = False
+        # Whether chunked requests are enabled, see ``enable_chunked_requests``
+        self._chunked_requests = False
         super().__init__(endpoint_name, relation_ids=relation_ids)
 
+    @property
+    def unique_id(self):
+        """Get unique ID used when requesting a key from Ceph.
+
+        Defaults to the hostname of the unit, which is looked up on first
+        use and shared by all endpoints.
+
+        :rtype: str
+        """
+        global _hostname
+        if self._unique_id is None:
+            if _hostname is None:
+                _hostname = socket.gethostname()
+            self._unique_id = _hostname
+        return self._unique_id
+
+    @unique_id.setter
+    def unique_id(self, value):
+        self._unique_id = value or None
+
+    @property
+    def key_name(self):
+        """Get name of relation data key holding our key.
+
+        Derived from ``unique_id`` unless set explicitly.
+
+        :rtype: str
+        """
+        if self._key_name is not None:
+            return self._key_name
+        return '{}_key'.format(self.unique_id)
+
+    @key_name.setter
+    def key_name(self, value):
+        self._key_name = value
+
     @when('endpoint.{endpoint_name}.joined')
     def joined(self):
         set_flag(self.expand_name('{endpoint_name}.connected'))
 
     @when('endpoint.{endpoint_name}.changed')
     def changed(self):
+        # read before the flags required for availability are cleared
+        active_flags = set(get_flags())
         flags = (
             self.expand_name(
                 'endpoint.{endpoint_name}.changed.auth'),
@@ -65,10 +428,44 @@ class CephRBDMirrorRequires(Endpoint):
             self.expand_name(
                 'endpoint.{endpoint_name}.changed.ceph-public-address'),
         )
+        available = (self.expand_name('{endpoint_name}.available') in
+                     active_flags)
         if all_flags_set(*flags):
             for flag in (flags):
                 clear_flag(flag)
             set_flag(self.expand_name('{endpoint_name}.available'))
+            available = True
+        for key, changed_flags in self._changed_flags():
+            flag = self.expand_name('endpoint.{endpoint_name}.changed.' + key)
+            if flag not in active_flags:
+                continue
+            for changed_flag in changed_flags:
+                set_flag(self.expand_name(changed_flag))
+            # consumed once turned into the flags above, except for flags
+            # required for availability which are kept until it is reached
+            if available or flag not in flags:
+                clear_flag(flag)
+        self._reset_request_cache()
+        self._pool_index = None
+        self._key_material = None
+        self._broker_requests = None
+
+    def _changed_flags(self):
+        """Get flags to set on change of each received relation data key.
+
+        :returns: Relation data key and flags for each key.
+        :rtype: List[Tuple[str, Tuple[str, ...]]]
+        """
+        return [
+            ('auth', ('{endpoint_name}.key.changed',)),
+            (self.key_name, ('{endpoint_name}.key.changed',)),
+            ('ceph-public-address', ('{endpoint_name}.mon_hosts.changed',
+                                     '{endpoint_name}.networks.changed')),
+            ('ceph-cluster-address', ('{endpoint_name}.networks.changed',)),
+            ('pools', ('{endpoint_name}.pools.changed',)),
+            ('pools-delta', ('{endpoint_name}.pools.changed',)),
+            ('broker_requests', ('{endpoint_name}.broker_requests.changed',)),
+        ]
 
     @when_not('endpoint.{endpoint_name}.joined')
     def broken(self):
@@ -76,14 +473,41 @@ class CephRBDMirrorRequires(Endpoint):
         clear_flag(self.expand_name('{endpoint_name}.connected'))
 
     def request_key(self):
-        """Request key from Ceph by providing our unique ID."""
+        """Request key from Ceph by providing our unique ID.
+
+        Relations where a key for ``key_name`` has already been received, as
+        recorded in unit-local storage, are left alone.
+        """
+        record = self._get_key_record()
         for relation in self.relations:
-            relation.to_publish['unique_id'] = self.unique_id
+            if relation.relation_id in record.get('relations', ()):
+                continue
+            self._publish(relation, 'unique_id', self.unique_id)
 
-    def refresh_pools(self):
-        """Refresh list of pools by setting a nonce on the relation."""
+    def refresh_pools(self, names=None, since=None):
+        """Refresh list of pools by setting a nonce on the relation.
+
+        Without arguments the ceph-mon is asked to publish the full list of
+        pools.  A ceph-mon that supports pool deltas can instead be asked to
+        only publish specific pools, or the changes since a given generation
+        of the pool map, in the ``pools-delta`` key.  Keys for arguments not
+        given are removed from the relation.
+
+        :param names: Only refresh these pools.
+        :type names: Optional[Iterable[str]]
+        :param since: Only refresh pools changed since this generation, see
+                      ``pools_generation``.
+        :type since: Optional[int]
+        """
+        names = sorted(set(names)) if names else None
         for relation in self.relations:
-            relation.to_publish['nonce'] = str(uuid.uuid4())
+            for key, value in (('refresh-pools', names),
+                               ('pools-since', since)):
+                if value is None:
+                    self._unpublish(relation, key)
+                else:
+                    self._publish(relation, key, value)
+            self._publish(relation, 'nonce', str(uuid.uuid4()))
 
     def create_replicated_pool(self, name, replicas=3, weight=None,
                                pg_num=None, group=None, namespace=None,
@@ -94,33 +518,18 @@ class CephRBDMirrorRequires(Endpoint):
         Refer to charm-helpers ``add_op_create_replicated_pool`` function for
         documentation of parameters.
         """
-        # Ensure type of numeric values before sending over the wire
-        replicas = int(replicas) if replicas else None
-        weight = float(weight) if weight else None
-        pg_num = int(pg_num) if pg_num else None
-        max_bytes = int(max_bytes) if max_bytes else None
-        max_objects = int(max_objects) if max_objects else None
-
-        for relation in self.relations:
-            current_request = ch_ceph.get_previous_request(
-                relation.relation_id) or ch_ceph.CephBrokerRq()
-            for req in current_request.ops:
-                if 'op' in req and 'name' in req:
-                    if req['op'] == 'create-pool' and req['name'] == name:
-                        # request already exists, don't create a new one
-                        return
-            current_request.add_op_create_replicated_pool(
-                name="{}".format(name),
-                replica_count=replicas,
-                pg_num=pg_num,
-                weight=weight,
-                group=group,
-                namespace=namespace,
-                app_name=app_name,
-                max_bytes=max_bytes,
-                max_objects=max_objects)
-            ch_ceph.send_request_if_needed(current_request,
-                                           relation=self.endpoint_name)
+        self.create_pools([{
+            'name': name,
+            'pool_type': 'replicated',
+            'replicas': replicas,
+            'weight': weight,
+            'pg_num': pg_num,
+            'group': group,
+            'namespace': namespace,
+            'app_name': app_name,
+            'max_bytes': max_bytes,
+            'max_objects': max_objects,
+        }])
 
     def create_erasure_pool(self, name, erasure_profile=None, weight=None,
                             group=None, app_name=None, max_bytes=None,
@@ -130,29 +539,375 @@ class CephRBDMirrorRequires(Endpoint):
         Refer to charm-helpers ``add_op_create_erasure_pool``function for
         documentation of parameters.
         """
+        self.create_pools([{
+            'name': name,
+            'pool_type': 'erasure',
+            'erasure_profile': erasure_profile,
+            'weight': weight,
+            'group': group,
+            'app_name': app_name,
+            'max_bytes': max_bytes,
+            'max_objects': max_objects,
+        }])
+
+    def create_pools(self, specs):
+        """Request setup of multiple pools in one broker request.
+
+        The previous broker request for each relation is retrieved once, all
+        missing pools are added to it and the result is sent at most once per
+        relation.  Pools that already have a ``create-pool`` operation in the
+        previous request are left alone.
+
+        :param specs: Pool specifications.  Each specification is a dict with
+                      a ``name`` key, an optional ``pool_type`` key of
+                      either ``replicated`` (default) or ``erasure`` and any
+                      further keyword arguments accepted by
+                      ``create_replicated_pool`` or ``create_erasure_pool``.
+        :type specs: Iterable[Dict[str, Any]]
+        :raises: ValueError
+        """
+        specs = [dict(spec) for spec in specs]
+        for spec in specs:
+            if spec.setdefault('pool_type', 'replicated') not in (
+                    'replicated', 'erasure'):
+                raise ValueError('Unknown pool type "{}" for pool "{}"'
+                                 .format(spec['pool_type'], spec.get('name')))
+        for relation in self.relations:
+            current_request = self._previous_request(relation.relation_id)
+            op_index = self._op_index(relation.relation_id)
+            added = False
+            for spec in specs:
+                if ('create-pool', spec['name']) in op_index:
+                    # request already exists, don't create a new one
+                    continue
+                spec = spec.copy()
+                if spec.pop('pool_type') == 'erasure':
+                    self._add_op_create_erasure_pool(current_request, **spec)
+                else:
+                    self._add_op_create_replicated_pool(current_request,
+                                                        **spec)
+                op_index[('create-pool', spec['name'])] = (
+                    current_request.ops[-1])
+                added = True
+            if added:
+                self._send_request(current_request)
+                self._update_sent_digest(relation, None)
+
+    @contextlib.contextmanager
+    def batch_publish(self):
+        """Batch sending of broker requests.
+
+        Within the context broker requests are not sent right away.  When the
+        outermost context ends without error only the latest request is
+        sent.  Requests made within a context that raises are discarded and
+        not remembered as sent, so they can be made again.
+        Pool creation and ``maybe_send_rq`` calls can thus be combined
+        without waking the ceph-mon up for each of them.
+
+        Other published keys are always written once per relation at the end
+        of the hook by the reactive framework, and keys set to the value they
+        already have are not written at all.
+
+        Usage::
+
+            with endpoint.batch_publish():
+                endpoint.request_key()
+                endpoint.create_replicated_pool('rbd')
+                endpoint.maybe_send_rq(rq)
+        """
+        pending_request = self._pending_request
+        pending_digests = len(self._pending_digests)
+        # cached requests are modified in place, keep their content to
+        # restore them should the context fail
+        previous_requests = {
+            relation_id: rq.request
+            for relation_id, rq in self._previous_requests.items()}
+        self._batch_depth += 1
+        try:
+            yield self
+        except Exception:
+            # discard requests batched within the failed context along with
+            # their digests and cached requests
+            self._pending_request = pending_request
+            del self._pending_digests[pending_digests:]
+            self._reset_request_cache()
+            for relation_id, raw in previous_requests.items():
+                self._previous_requests[relation_id] = ch_ceph.CephBrokerRq(
+                    raw_request_data=raw)
+            raise
+        finally:
+            self._batch_depth -= 1
+        if not self._batch_depth:
+            rq, self._pending_request = self._pending_request, None
+            digests, self._pending_digests = self._pending_digests, []
+            if rq:
+                self._send_request(rq)
+            for relation, digest in digests:
+                self._update_sent_digest(relation, digest)
+
+    def _send_request(self, rq):
+        """Send broker request on every relation unless sending is batched.
+
+        :param rq: Broker request to send.
+        :type rq: ch_ceph.CephBrokerRq
+        """
+        if self._batch_depth:
+            self._pending_request = rq
+            return
+        self._call('send_request', self._publish_request, rq)
+
+    def _publish_request(self, rq):
+        """Publish broker request on every relation where it is not sent.
+
+        Like charm-helpers ``send_request_if_needed``, a request equivalent
+        to the previous request on a relation is not sent again.  Requests
+        are compact encoded and chunked on relations where every remote unit
+        supports it and the feature is enabled.
+
+        NOTE: charm-helpers ``send_request_if_needed`` is not used as it can
+        not read back compact encoded or chunked requests, and it writes with
+        relation-set directly, which the reactive framework may overwrite
+        with stale data when it publishes the endpoint data at the end of the
+        hook.
+
+        :param rq: Broker request to send.
+        :type rq: ch_ceph.CephBrokerRq
+        """
+        for relation in self.relations:
+            compact = self._compact_encoding and self._remote_supports(
+                relation, 'broker-encodings', COMPACT_ENCODING)
+            if self._chunked_requests and self._remote_supports(
+                    relation, 'broker-features', CHUNKED_REQUESTS):
+                self._publish_chunks(relation, rq, compact)
+                continue
+            self._clear_chunks(relation)
+            raw = relation.to_publish_raw.get('broker_req')
+            if raw and ch_ceph.CephBrokerRq(
+                    raw_request_data=_unpack(raw)) == rq:
+                continue
+            if compact:
+                encoded = _encode_compact(json.loads(rq.request))
+            else:
+                encoded = rq.request
+            self._call('published_write', relation.to_publish_raw.__setitem__,
+                       'broker_req', encoded)
+            # like charm-helpers, written raw as the ceph-mon names its
+            # response key after it
+            self._publish_raw(relation, 'unit-name', ch_hookenv.local_unit())
+
+    def _publish_chunks(self, relation, rq, compact=False):
+        """Publish broker request in content addressed chunks.
+
+        Each chunk of operations is published in a ``broker_req_chunk.<id>``
+        key and the ``broker_req_chunks`` manifest lists the chunks of the
+        request in order.  Only chunks not already on the relation are
+        written and chunks no longer part of the request are removed, as is
+        a request previously published whole in ``broker_req``.
+
+        :param relation: Relation to publish request on.
+        :type relation: charms.reactive.endpoints.Relation
+        :param rq: Broker request to send.
+        :type rq: ch_ceph.CephBrokerRq
+        :param compact: Compact encode the published data.
+        :type compact: bool
+        """
+        if relation.to_publish_raw.get('broker_req'):
+            self._call('published_write', relation.to_publish_raw.__setitem__,
+                       'broker_req', None)
+        chunks = _chunk_ops(rq.ops)
+        chunk_ids = [chunk_id for chunk_id, _ in chunks]
+        previous = []
+        raw = relation.to_publish_raw.get('broker_req_chunks')
+        if raw:
+            previous = json.loads(_unpack(raw))['chunks']
+        if chunk_ids == previous:
+            return
+
+        def encode(data):
+            if compact:
+                return _encode_compact(data)
+            return json.dumps(data, sort_keys=True)
+
+        for chunk_id, ops in chunks:
+            if chunk_id not in previous:
+                self._call('published_write',
+                           relation.to_publish_raw.__setitem__,
+                           'broker_req_chunk.' + chunk_id,
+                           encode({'api-version': rq.api_version,
+                                   'ops': ops}))
+        for chunk_id in set(previous) - set(chunk_ids):
+            self._call('published_write', relation.to_publish_raw.__setitem__,
+                       'broker_req_chunk.' + chunk_id, None)
+        self._call('published_write', relation.to_publish_raw.__setitem__,
+                   'broker_req_chunks',
+                   encode({'api-version': rq.api_version,
+                           'request-id': rq.request_id,
+                           'chunks': chunk_ids}))
+        self._publish_raw(relation, 'unit-name', ch_hookenv.local_unit())
+
+    def _clear_chunks(self, relation):
+        """Remove broker request published in chunks from relation.
+
+        :param relation: Relation to remove request from.
+        :type relation: charms.reactive.endpoints.Relation
+        """
+        raw = relation.to_publish_raw.get('broker_req_chunks')
+        if not raw:
+            return
+        for chunk_id in json.loads(_unpack(raw))['chunks']:
+            self._call('published_write', relation.to_publish_raw.__setitem__,
+                       'broker_req_chunk.' + chunk_id, None)
+        self._call('published_write', relation.to_publish_raw.__setitem__,
+                   'broker_req_chunks', None)
+
+    @staticmethod
+    def _read_chunks(relation):
+        """Get broker request published in chunks on relation.
+
+        :param relation: Relation to get request for.
+        :type relation: charms.reactive.endpoints.Relation
+        :returns: Broker request as JSON, None if not published in chunks.
+        :rtype: Optional[str]
+        """
+        raw = relation.to_publish_raw.get('broker_req_chunks')
+        if not raw:
+            return None
+        manifest = json.loads(_unpack(raw))
+        ops = []
+        for chunk_id in manifest['chunks']:
+            chunk = relation.to_publish_raw['broker_req_chunk.' + chunk_id]
+            ops.extend(json.loads(_unpack(chunk))['ops'])
+        return json.dumps({'api-version': manifest['api-version'],
+                           'request-id': manifest['request-id'],
+                           'ops': ops})
+
+    def _remote_supports(self, relation, key, feature):
+        """Whether all remote units of relation advertise feature in key.
+
+        :param relation: Relation to check.
+        :type relation: charms.reactive.endpoints.Relation
+        :param key: Relation data key listing supported features.
+        :type key: str
+        :param feature: Feature to check for.
+        :type feature: str
+        :rtype: bool
+        """
+        units = list(relation.units)
+        return bool(units) and all(
+            feature in (self._received(key, unit) or []) for unit in units)
+
+    def _previous_request(self, relation_id):
+        """Get previous broker request for relation.
+
+        The request is retrieved from the relation once per hook and the
+        cached object is updated in place as operations are added through
+        this endpoint.  The cache is reset when relation data changes.
+
+        :param relation_id: Relation to get previous request for.
+        :type relation_id: str
+        :returns: Previous request or a new empty request.
+        :rtype: ch_ceph.CephBrokerRq
+        """
+        if relation_id not in self._previous_requests:
+            rq = self._call('previous_request_read',
+                            self._read_previous_request, relation_id)
+            self._previous_requests[relation_id] = rq or ch_ceph.CephBrokerRq()
+        return self._previous_requests[relation_id]
+
+    def _read_previous_request(self, relation_id):
+        """Read broker request published by this unit on relation.
+
+        The request is read whether it is published in plain JSON, compact
+        encoded or in chunks, regardless of what is enabled in this hook.
+
+        NOTE: charm-helpers ``get_previous_request`` can not read compact
+        encoded or chunked requests, and does not see data published by this
+        endpoint earlier in the hook.
+
+        :param relation_id: Relation to read request from.
+        :type relation_id: str
+        :returns: Broker request or None
+        :rtype: Optional[ch_ceph.CephBrokerRq]
+        """
+        relation = self.relations[relation_id]
+        raw = self._read_chunks(relation)
+        if raw is None:
+            raw = relation.to_publish_raw.get('broker_req')
+            raw = raw and _unpack(raw)
+        if raw:
+            return ch_ceph.CephBrokerRq(raw_request_data=raw)
+
+    def _op_index(self, relation_id):
+        """Get index of operations in previous broker request for relation.
+
+        The index is built once per hook for each relation and is kept up to
+        date as operations are added or requests are sent through this
+        endpoint, which makes membership checks O(1).
+
+        Operations without both an ``op`` and a ``name`` key are not indexed.
+
+        :param relation_id: Relation to get index for.
+        :type relation_id: str
+        :returns: Operations keyed by ``(op, name)``.
+        :rtype: Dict[Tuple[str, str], Dict[str, Any]]
+        """
+        if relation_id not in self._op_indexes:
+            self._op_indexes[relation_id] = self._build_op_index(
+                self._previous_request(relation_id).ops)
+        return self._op_indexes[relation_id]
+
+    def _reset_request_cache(self):
+        self._previous_requests.clear()
+        self._op_indexes.clear()
+
+    @staticmethod
+    def _build_op_index(ops):
+        return {
+            (op['op'], op['name']): op
+            for op in ops
+            if 'op' in op and 'name' in op
+        }
+
+    @staticmethod
+    def _add_op_create_replicated_pool(rq, name, replicas=3, weight=None,
+                                       pg_num=None, group=None,
+                                       namespace=None, app_name=None,
+                                       max_bytes=None, max_objects=None):
         # Ensure type of numeric values before sending over the wire
+        replicas = int(replicas) if replicas else None
         weight = float(weight) if weight else None
+        pg_num = int(pg_num) if pg_num else None
         max_bytes = int(max_bytes) if max_bytes else None
         max_objects = int(max_objects) if max_objects else None
 
-        for relation in self.relations:
-            current_request = ch_ceph.get_previous_request(
-                relation.relation_id) or ch_ceph.CephBrokerRq()
-            for req in current_request.ops:
-                if 'op' in req and 'name' in req:
-                    if req['op'] == 'create-pool' and req['name'] == name:
-                        # request already exists, don't create a new one
-                        return
-            current_request.add_op_create_erasure_pool(
-                name="{}".format(name),
-                erasure_profile=erasure_profile,
-                weight=weight,
-                group=group,
-                app_name=app_name,
-                max_bytes=max_bytes,
-                max_objects=max_objects)
-            ch_ceph.send_request_if_needed(current_request,
-                                           relation=self.endpoint_name)
+        rq.add_op_create_replicated_pool(
+            name="{}".format(name),
+            replica_count=replicas,
+            pg_num=pg_num,
+            weight=weight,
+            group=group,
+            namespace=namespace,
+            app_name=app_name,
+            max_bytes=max_bytes,
+            max_objects=max_objects)
+
+    @staticmethod
+    def _add_op_create_erasure_pool(rq, name, erasure_profile=None,
+                                    weight=None, group=None, app_name=None,
+                                    max_bytes=None, max_objects=None):
+        # Ensure type of numeric values before sending over the wire
+        weight = float(weight) if weight else None
+        max_bytes = int(max_bytes) if max_bytes else None
+        max_objects = int(max_objects) if max_objects else None
+
+        rq.add_op_create_erasure_pool(
+            name="{}".format(name),
+            erasure_profile=erasure_profile,
+            weight=weight,
+            group=group,
+            app_name=app_name,
+            max_bytes=max_bytes,
+            max_objects=max_objects)
 
     def maybe_send_rq(self, rq):
         """Send single broker request with all operations if needed.
@@ -166,43 +921,259 @@ class CephRBDMirrorRequires(Endpoint):
         operations and collapse into one new single broker request that is
         maintained with the ceph-mon in the other end.
 
+        A digest of the operations is compared with the digest of what was
+        last sent on each relation, and the request is neither decoded nor
+        sent again when they match and the request published on the relation
+        is still the one sent.  Relations where the previous broker
+        request already holds the exact same set of operations are skipped
+        without decoding the request again.
+
         :param rq: Broker Request to evaluate for sending.
         :type rq: ch_ceph.CephBrokerRq
         """
+        # the request sent is cached, copy it as the caller may go on to
+        # modify its request
+        self._maybe_send_ops(
+            rq.ops, _ops_digest(rq.ops),
+            lambda: ch_ceph.CephBrokerRq(raw_request_data=rq.request))
+
+    def _maybe_send_ops(self, ops, digest, get_rq, rq_index=None):
+        """Send broker request with operations if needed.
+
+        :param ops: Operations of the broker request.
+        :type ops: List[Dict[str, Any]]
+        :param digest: Digest of operations, see ``_ops_digest``.
+        :type digest: str
+        :param get_rq: Called to get the broker request when it is to be
+                       sent.  The request is cached, so it must not be
+                       modified by the caller afterwards.
+        :type get_rq: Callable[[], ch_ceph.CephBrokerRq]
+        :param rq_index: Index of operations, see ``_build_op_index``.  Built
+                         when first needed if not given.
+        :type rq_index: Optional[Dict[Tuple[str, str], Dict[str, Any]]]
+        :returns: Index of operations, None when it was not needed.
+        :rtype: Optional[Dict[Tuple[str, str], Dict[str, Any]]]
+        """
+        pending = []
         for relation in self.relations:
-            ch_ceph.send_request_if_needed(rq, relation=self.endpoint_name)
+            # the digest is only trusted while the request it was recorded
+            # for is still what is published on the relation
+            if self._get_sent_digests().get(relation.relation_id) == [
+                    digest, self._published_marker(relation)]:
+                continue
+            if rq_index is None:
+                rq_index = self._build_op_index(ops)
+            # both requests must be fully indexed for equal indexes to mean
+            # equal sets of operations
+            if (ops and len(rq_index) == len(ops) and
+                    self._op_index(relation.relation_id) == rq_index and
+                    len(self._previous_request(relation.relation_id).ops) ==
+                    len(rq_index)):
+                self._update_sent_digest(relation, digest)
+                continue
+            pending.append(relation)
+        if pending:
+            rq = get_rq()
+            # the request is sent on every relation of the endpoint so one
+            # call covers all pending relations.
+            self._send_request(rq)
+            for n, relation in enumerate(pending):
+                # requests are modified in place when pools are added, so
+                # every relation caches a request of its own
+                self._previous_requests[relation.relation_id] = (
+                    ch_ceph.CephBrokerRq(raw_request_data=rq.request)
+                    if n else rq)
+                # indexed again from the cached request when needed, as
+                # rq_index refers to the operations of the caller
+                self._op_indexes.pop(relation.relation_id, None)
+                self._update_sent_digest(relation, digest)
+        return rq_index
+
+    def _get_sent_digests(self):
+        if self._sent_digests is None:
+            self._sent_digests = ch_unitdata.kv().get(
+                self._kv_key('sent_digests')) or {}
+        return self._sent_digests
+
+    def _update_sent_digest(self, relation, digest):
+        """Update persisted digest of broker request sent on relation.
+
+        The digest is stored along with the marker of the request published
+        on the relation, see ``_published_marker``.  Within ``batch_publish``
+        the update is deferred until the batched request is sent.
+
+        :param relation: Relation the request was sent on.
+        :type relation: charms.reactive.endpoints.Relation
+        :param digest: Digest of operations sent, None when unknown.
+        :type digest: Optional[str]
+        """
+        if self._batch_depth:
+            # recorded once the request is actually sent
+            self._pending_digests.append((relation, digest))
+            return
+        digests = self._get_sent_digests()
+        entry = None
+        if digest is not None:
+            entry = [digest, self._published_marker(relation)]
+        if digests.get(relation.relation_id) == entry:
+            return
+        if entry is None:
+            del digests[relation.relation_id]
+        else:
+            digests[relation.relation_id] = entry
+        ch_unitdata.kv().set(self._kv_key('sent_digests'), digests)
+
+    @staticmethod
+    def _published_marker(relation):
+        """Get marker of the broker request published on relation.
+
+        The marker changes whenever the published request changes, also when
+        it is changed or removed by something other than this endpoint.
+        Chunks are content addressed so the manifest covers them.
+
+        :param relation: Relation to get marker for.
+        :type relation: charms.reactive.endpoints.Relation
+        :rtype: str
+        """
+        return hashlib.sha256('\n'.join(
+            relation.to_publish_raw.get(key) or ''
+            for key in ('broker_req', 'broker_req_chunks')
+        ).encode('utf-8')).hexdigest()
+
+    def _kv_key(self, name):
+        """Get key for endpoint data in unit-local storage."""
+        return 'ceph-rbd-mirror.{}.{}'.format(self.endpoint_name, name)
 
     @property
     def auth(self):
         """Retrieve ``auth`` from relation data."""
-        return self.all_joined_units.received['auth']
+        return self._get_key_material()['auth']
 
     @property
     def key(self):
         """Retrieve key from relation data."""
-        return self.all_joined_units.received[self.key_name]
+        return self._get_key_material()['key']
+
+    @property
+    def key_fingerprint(self):
+        """Get fingerprint of the key and auth received from the ceph-mon.
+
+        Charms can compare the fingerprint with the one used to render the
+        keyring and skip rewriting it when they match.
+
+        :returns: Fingerprint or None when no key is received.
+        :rtype: Optional[str]
+        """
+        return self._get_key_material()['fingerprint']
+
+    def _get_key_material(self):
+        """Get key and auth received on the relation.
+
+        The relation data is read once per hook.  The key, auth, their
+        fingerprint and the relations the key was received on are recorded
+        in unit-local storage, see ``request_key``.
+
+        :returns: ``auth``, ``key`` and ``fingerprint``.
+        :rtype: Dict[str, Optional[str]]
+        """
+        if self._key_material is None:
+            auth = self._received('auth')
+            key = self._received(self.key_name)
+            fingerprint = None
+            if key:
+                fingerprint = hashlib.sha256(json.dumps(
+                    [self.key_name, auth, key]).encode('utf-8')).hexdigest()
+            self._key_material = {
+                'auth': auth,
+                'key': key,
+                'fingerprint': fingerprint,
+            }
+            record = {}
+            if key:
+                record = {
+                    'key_name': self.key_name,
+                    'fingerprint': fingerprint,
+                    'auth': auth,
+                    'key': key,
+                    'relations': sorted(
+                        relation.relation_id for relation in self.relations
+                        if self._received(self.key_name,
+                                          relation.joined_units)),
+                }
+            if record != self._get_key_record():
+                ch_unitdata.kv().set(self._kv_key('key'), record)
+                self._key_record = record
+        return self._key_material
 
-    def mon_hosts(self):
+    def _get_key_record(self):
+        """Get key material recorded in unit-local storage for ``key_name``.
+
+        :rtype: Dict[str, Any]
+        """
+        if self._key_record is None:
+            record = ch_unitdata.kv().get(self._kv_key('key')) or {}
+            if record.get('key_name') != self.key_name:
+                record = {}
+            self._key_record = record
+        return self._key_record
+
+    def mon_hosts(self, port=MSGR1_PORT, addrvec=False):
         """Providwe iterable with address of individual related ceph-mon units.
 
+        Addresses are de-duplicated and sorted so that the order is stable
+        regardless of relation and unit order.
+
         NOTE(fnordahl): As much as this should and could have been a property
         we have pre-existing interfaces providing this as a function.  To be
         able to use the same code for relation adaption etc in
         ``charms.openstack`` we must keep having this as a function unless we
         go back and change both to being properties.
+
+        :param port: Port to use, for example ``MSGR2_PORT`` for messenger v2.
+        :type port: int
+        :param addrvec: Provide messenger v2 and v1 address vectors, such as
+                        ``[v2:192.0.2.1:3300,v1:192.0.2.1:6789]``, in which
+                        case ``port`` is ignored.
+        :type addrvec: bool
         """
-        for relation in self.relations:
-            for unit in relation.units:
+        for addr in self._mon_addresses():
+            if isinstance(addr, ipaddress.IPv6Address):
+                host = '[{}]'.format(addr)
+            else:
+                host = str(addr)
+            if addrvec:
+                yield '[v2:{0}:{1},v1:{0}:{2}]'.format(
+                    host, MSGR2_PORT, MSGR1_PORT)
+            else:
+                yield '{}:{}'.format(host, port)
+
+    def _mon_addresses(self):
+        """Get sorted and de-duplicated addresses of related ceph-mon units.
+
+        The addresses are only parsed again when the ``ceph-public-address``
+        of any unit changes.
+
+        :returns: Valid addresses, IPv4 before IPv6.
+        :rtype: List[Union[ipaddress.IPv4Address, ipaddress.IPv6Address]]
+        """
+        raw_addrs = [
+            self._received('ceph-public-address', unit) or ''
+            for relation in self.relations
+            for unit in relation.units
+        ]
+        if raw_addrs != self._mon_addrs_raw:
+            addrs = set()
+            for raw_addr in raw_addrs:
                 try:
-                    addr = ipaddress.ip_address(
-                        unit.received.get('ceph-public-address', ''))
+                    addrs.add(ipaddress.ip_address(raw_addr))
                 except ValueError:
-                    continue
-                port = 6789
-                if isinstance(addr, ipaddress.IPv6Address):
-                    yield '[{}]:{}'.format(addr, port)
-                else:
-                    yield '{}:{}'.format(addr, port)
+                    addr = self._resolve_host(raw_addr)
+                    if addr:
+                        addrs.add(ipaddress.ip_address(addr))
+            self._mon_addrs = sorted(
+                addrs, key=lambda addr: (addr.version, addr))
+            self._mon_addrs_raw = raw_addrs
+        return self._mon_addrs
 
     @property
     def public_network(self):
@@ -215,15 +1186,9 @@ class CephRBDMirrorRequires(Endpoint):
         :returns: CIDR or None
         :rtype: Option[str, None]
         """
-        public_addr = self.all_joined_units.received['ceph-public-address']
+        public_addr = self._address(self._received('ceph-public-address'))
         if public_addr:
-            try:
-                return ch_ip.resolve_network_cidr(public_addr)
-            except AddrFormatError:
-                # LP#1898299 in some cases the netmask will be None, which
-                # leads to an AddrFormatError. In this case, we should return
-                # None
-                return None
+            return _resolve_network_cidr(public_addr, self.metrics)
 
     @property
     def cluster_network(self):
@@ -236,25 +1201,507 @@ class CephRBDMirrorRequires(Endpoint):
         :returns: CIDR or None
         :rtype: Option[str, None]
         """
-        cluster_addr = self.all_joined_units.received['ceph-cluster-address']
+        cluster_addr = self._address(self._received('ceph-cluster-address'))
         if cluster_addr:
+            return _resolve_network_cidr(cluster_addr, self.metrics)
+
+    def _address(self, host):
+        """Get address for address or hostname advertised on the relation.
+
+        :param host: Advertised address or hostname.
+        :type host: Optional[str]
+        :returns: Address or None
+        :rtype: Optional[str]
+        """
+        if not host:
+            return None
+        try:
+            ipaddress.ip_address(host)
+            return host
+        except ValueError:
+            return self._resolve_host(host)
+
+    def _resolve_host(self, host):
+        """Resolve hostname advertised on the relation.
+
+        On the first lookup in a hook, every hostname advertised by the
+        related ceph-mon units in ``ceph-public-address`` and
+        ``ceph-cluster-address`` is resolved at once.
+
+        :param host: Hostname to resolve.
+        :type host: str
+        :returns: Address or None
+        :rtype: Optional[str]
+        """
+        if not isinstance(host, str) or not _HOSTNAME_RE.match(host):
+            return None
+        if host not in _resolved_hosts:
+            self._resolve_advertised_hosts(host)
+        return _resolved_hosts.get(host)
+
+    def _resolve_advertised_hosts(self, host):
+        """Resolve hostnames advertised on the relation and host.
+
+        Unexpired results are taken from unit-local storage and the
+        remaining hostnames are resolved concurrently.  Where a lookup does
+        not complete before the deadline of the hook an expired result is
+        used, if any.
+
+        :param host: Hostname to resolve in addition to advertised ones.
+        :type host: str
+        """
+        hosts = {host}
+        for relation in self.relations:
+            for unit in relation.units:
+                for key in ('ceph-public-address', 'ceph-cluster-address'):
+                    value = self._received(key, unit)
+                    if (isinstance(value, str) and
+                            value not in _resolved_hosts and
+                            _HOSTNAME_RE.match(value)):
+                        hosts.add(value)
+        now = time.time()
+        db = ch_unitdata.kv()
+        cache = db.get(self._kv_key('resolved_hosts')) or {}
+        pending = []
+        for name in sorted(hosts):
             try:
-                return ch_ip.resolve_network_cidr(cluster_addr)
-            except AddrFormatError:
-                # LP#1898299 in some cases the netmask will be None, which
-                # leads to an AddrFormatError. In this case, we should return
-                # None
-                return None
+                ipaddress.ip_address(name)
+                continue
+            except ValueError:
+                pass
+            entry = cache.get(name)
+            if entry and entry['expires'] > now:
+                _resolved_hosts[name] = entry['addr']
+            else:
+                pending.append(name)
+        if not pending:
+            return
+        resolved = self._call('resolve_hostnames', _resolve_hostnames,
+                              pending)
+        for name in pending:
+            if name in resolved:
+                addr = resolved[name]
+                cache[name] = {
+                    'addr': addr,
+                    'expires': now + (RESOLVE_TTL if addr
+                                      else RESOLVE_NEGATIVE_TTL),
+                }
+                _resolved_hosts[name] = addr
+            else:
+                _resolved_hosts[name] = (cache.get(name) or {}).get('addr')
+        db.set(self._kv_key('resolved_hosts'), {
+            name: entry for name, entry in cache.items()
+            if entry['expires'] > now or name in hosts})
 
     @property
     def pools(self):
-        return self.all_joined_units.received['pools']
+        """Retrieve pools known by the ceph-mon.
+
+        When the ceph-mon publishes deltas in ``pools-delta`` they are merged
+        into a pool map kept in unit-local storage, otherwise the full list
+        published in ``pools`` is used.
+
+        A delta that does not apply to the local pool map, or is malformed,
+        means the local pool map can not be brought up to date.  It is then
+        dropped and a full pool map is requested with ``refresh_pools``, once
+        for each such delta, and the full list published in ``pools``, if
+        any, is used until the full pool map arrives.
+
+        :returns: Pool details keyed by pool name.
+        :rtype: Optional[Dict[str, Any]]
+        """
+        delta = self._received('pools-delta')
+        if delta:
+            merged = self._merge_pools_delta(delta)
+            if merged:
+                return merged['pools']
+            self._request_full_pools(delta)
+        return self._received('pools')
+
+    @property
+    def pool_index(self):
+        """Index of pools known by the ceph-mon.
+
+        The index is built once and reused until relation data changes.
+        Pools with an ``erasure_code_profile`` parameter are considered
+        erasure coded, all other pools replicated.
+
+        :returns: Pool details keyed by pool name, sorted pool names keyed by
+                  application name and sorted pool names keyed by pool type.
+        :rtype: PoolIndex
+        """
+        if self._pool_index is None:
+            by_name = self.pools or {}
+            by_app = collections.defaultdict(list)
+            by_type = collections.defaultdict(list)
+            for name in sorted(by_name):
+                pool = by_name[name] or {}
+                for app_name in pool.get('applications') or {}:
+                    by_app[app_name].append(name)
+                if (pool.get('parameters') or {}).get('erasure_code_profile'):
+                    by_type['erasure'].append(name)
+                else:
+                    by_type['replicated'].append(name)
+            self._pool_index = PoolIndex(by_name, dict(by_app), dict(by_type))
+        return self._pool_index
+
+    @property
+    def pools_generation(self):
+        """Generation of the locally merged pool map.
+
+        :returns: Generation or None when no delta has been merged.
+        :rtype: Optional[int]
+        """
+        merged = self._merged_pools or ch_unitdata.kv().get(
+            self._kv_key('pools'))
+        if merged:
+            return merged['generation']
+
+    def _merge_pools_delta(self, delta):
+        """Merge pool delta published by the ceph-mon into local pool map.
+
+        The delta is a dict with the ``generation`` of the pool map it
+        produces, the ``since`` generation it applies to, or None for a full
+        map, the ``pools`` added or changed and the names of ``removed``
+        pools.
+
+        :param delta: Pool delta.
+        :type delta: Dict[str, Any]
+        :returns: Merged pool map with ``generation`` and ``pools`` keys or
+                  None if the delta is malformed or does not apply to the
+                  local pool map.
+        :rtype: Optional[Dict[str, Any]]
+        """
+        if not isinstance(delta, dict) or 'generation' not in delta:
+            return None
+        if (self._merged_pools and
+                self._merged_pools['generation'] == delta['generation']):
+            return self._merged_pools
+        db = ch_unitdata.kv()
+        merged = db.get(self._kv_key('pools')) or {
+            'generation': None, 'pools': {}}
+        if merged['generation'] != delta['generation']:
+            if delta.get('since') is None:
+                pools = {}
+            elif delta['since'] == merged['generation']:
+                pools = dict(merged['pools'])
+            else:
+                return None
+            pools.update(delta.get('pools') or {})
+            for name in delta.get('removed') or []:
+                pools.pop(name, None)
+            merged = {'generation': delta['generation'], 'pools': pools}
+            db.set(self._kv_key('pools'), merged)
+        self._merged_pools = merged
+        return merged
+
+    def _request_full_pools(self, delta):
+        """Drop local pool map and request full pool map from the ceph-mon.
+
+        The request is made once for each delta that does not apply, so the
+        ceph-mon is not asked again in every hook until it answers.
+
+        :param delta: Pool delta that does not apply.
+        :type delta: Any
+        """
+        db = ch_unitdata.kv()
+        self._merged_pools = None
+        if db.get(self._kv_key('pools')) is not None:
+            db.unset(self._kv_key('pools'))
+        digest = hashlib.sha256(json.dumps(
+            delta, sort_keys=True).encode('utf-8')).hexdigest()
+        if db.get(self._kv_key('pools_refresh')) != digest:
+            self.refresh_pools()
+            db.set(self._kv_key('pools_refresh'), digest)
 
     @property
     def broker_requests(self):
-        if ('broker_requests' in self.all_joined_units.received and
-                self.all_joined_units.received['broker_requests'] is not None):
-            for json_rq in self.all_joined_units.received['broker_requests']:
-                yield json.loads(json_rq)
+        """Iterate over decoded broker requests received from the ceph-mon.
+
+        Decoded requests are cached for the duration of the hook and must not
+        be modified by the caller.
+        """
+        yield from self._decode_broker_requests()
         # Empty return in generator provides empty iterator and not None PEP479
         return
+
+    def get_broker_request(self, request_id):
+        """Get decoded broker request received from the ceph-mon by its ID.
+
+        The lookup uses an index built when the requests are decoded, see
+        ``broker_requests``.
+
+        :param request_id: The ``request-id`` of the broker request.
+        :type request_id: str
+        :returns: Decoded broker request or None
+        :rtype: Optional[Dict[str, Any]]
+        """
+        self._decode_broker_requests()
+        return self._broker_requests_by_id.get(request_id)
+
+    def broker_requests_delta(self):
+        """Get changes to received broker requests since the previous hook.
+
+        The broker requests seen are persisted in unit-local storage, which
+        is committed at the end of a successful hook.  The delta is computed
+        once per hook and subsequent calls return the same result.
+
+        Broker requests are identified by their ``request-id``, operations by
+        their content.
+
+        :returns: Lists of broker requests that were ``added``, ``removed``
+                  or ``changed`` and lists of operations that were
+                  ``ops_added`` or ``ops_removed``.
+        :rtype: Dict[str, List[Dict[str, Any]]]
+        """
+        if self._broker_requests_delta is not None:
+            return self._broker_requests_delta
+        kv_key = self._kv_key('broker_requests')
+        db = ch_unitdata.kv()
+        previous = db.get(kv_key) or {}
+        current = {}
+        for rq in self._decode_broker_requests():
+            rq_id = rq.get('request-id') or hashlib.sha256(
+                json.dumps(rq, sort_keys=True).encode('utf-8')).hexdigest()
+            current[rq_id] = rq
+
+        def ops_by_content(rqs):
+            return {
+                json.dumps(op, sort_keys=True): op
+                for rq in rqs.values()
+                for op in rq.get('ops', [])
+            }
+
+        previous_ops = ops_by_content(previous)
+        current_ops = ops_by_content(current)
+        self._broker_requests_delta = {
+            'added': [
+                rq for rq_id, rq in current.items() if rq_id not in previous],
+            'removed': [
+                rq for rq_id, rq in previous.items() if rq_id not in current],
+            'changed': [
+                rq for rq_id, rq in current.items()
+                if rq_id in previous and previous[rq_id] != rq],
+            'ops_added': [
+                op for key, op in current_ops.items()
+                if key not in previous_ops],
+            'ops_removed': [
+                op for key, op in previous_ops.items()
+                if key not in current_ops],
+        }
+        db.set(kv_key, current)
+        return self._broker_requests_delta
+
+    def _decode_broker_requests(self):
+        """Decode received broker requests, reusing decoded requests.
+
+        The relation data is read and decoded once per hook, and again after
+        ``changed`` ran.  Requests are keyed by a digest of their raw JSON
+        string so that unchanged requests are never decoded more than once.
+        Cached requests no longer present in relation data are dropped.
+
+        :returns: Decoded broker requests.
+        :rtype: List[Dict[str, Any]]
+        """
+        if self._broker_requests is not None:
+            return self._broker_requests
+        json_rqs = []
+        if 'broker_requests' in self.all_joined_units.received:
+            json_rqs = self._received('broker_requests') or []
+        if isinstance(json_rqs, str):
+            # compact encoded list of broker requests
+            json_rqs = self._call('json_loads', json.loads, _unpack(json_rqs))
+        cache = {}
+        decoded = []
+        for json_rq in json_rqs:
+            digest = hashlib.sha256(json_rq.encode('utf-8')).hexdigest()
+            if digest not in cache:
+                cache[digest] = self._broker_request_cache.get(digest)
+                if cache[digest] is None:
+                    cache[digest] = self._call('json_loads', json.loads,
+                                               _unpack(json_rq))
+            decoded.append(cache[digest])
+        if cache.keys() != self._broker_request_cache.keys():
+            self._broker_requests_by_id = {
+                rq['request-id']: rq
+                for rq in decoded
+                if isinstance(rq, dict) and 'request-id' in rq
+            }
+        self._broker_request_cache = cache
+        self._broker_requests = decoded
+        return decoded
+
+    def enable_compact_encoding(self):
+        """Enable compact encoding of broker requests for the hook.
+
+        Advertises support for compact encoded ``broker_requests`` to the
+        ceph-mon and sends broker requests compact encoded on relations where
+        every ceph-mon unit advertises support for it.  Plain JSON is used
+        with older peers.
+
+        Compact encoded requests already published are read back whether
+        compact encoding is enabled or not.
+        """
+        self._compact_encoding = True
+        for relation in self.relations:
+            self._publish(relation, 'broker-encodings', [COMPACT_ENCODING])
+
+    def enable_chunked_requests(self):
+        """Enable chunked publishing of broker requests for the hook.
+
+        Advertises support for chunked broker requests to the ceph-mon and
+        publishes broker requests split in content addressed chunks on
+        relations where every ceph-mon unit advertises support for it, so a
+        change to a large request only rewrites the chunks it affects.  The
+        whole request is sent in ``broker_req`` to older peers.
+
+        Once enabled, the charm must enable it in every hook.
+        """
+        self._chunked_requests = True
+        for relation in self.relations:
+            self._publish(relation, 'broker-features', [CHUNKED_REQUESTS])
+
+    def enable_metrics(self):
+        """Enable instrumentation of hot-path calls for the rest of the hook.
+
+        Counts and durations of reads of received relation data
+        (``received_read``), writes of published relation data
+        (``published_write``), broker requests sent (``send_request``), reads
+        of the previously sent request (``previous_request_read``), decoding
+        of received broker requests (``json_loads``) and hostname and network
+        lookups (``resolve_hostnames`` and ``resolve_network_cidr``) are
+        recorded, see ``metrics_summary``.  When not enabled the
+        instrumentation has close to no overhead.
+        """
+        if self.metrics is None:
+            self.metrics = HookMetrics()
+
+    def metrics_summary(self):
+        """Get summary of instrumented calls made during the hook.
+
+        :returns: Endpoint name, hook name and number of calls and total
+                  duration in seconds keyed by call name.
+        :rtype: Dict[str, Any]
+        """
+        return {
+            'endpoint': self.endpoint_name,
+            'hook': ch_hookenv.hook_name(),
+            'calls': self.metrics.summary() if self.metrics else {},
+        }
+
+    def log_metrics(self, level=ch_hookenv.DEBUG):
+        """Log summary of instrumented calls made during the hook.
+
+        :param level: Log level.
+        :type level: str
+        """
+        ch_hookenv.log('ceph-rbd-mirror metrics: {}'.format(
+            json.dumps(self.metrics_summary(), sort_keys=True)),
+            level=level)
+
+    def dump_metrics(self, path):
+        """Append summary of instrumented calls to file as a JSON line.
+
+        :param path: Path to file.
+        :type path: str
+        """
+        with open(path, 'a') as metrics_file:
+            metrics_file.write(
+                json.dumps(self.metrics_summary(), sort_keys=True) + '\n')
+
+    def _call(self, name, func, *args, **kwargs):
+        """Call function, recording the call when metrics are enabled."""
+        if self.metrics is None:
+            return func(*args, **kwargs)
+        return self.metrics.call(name, func, *args, **kwargs)
+
+    def _received(self, key, units=None):
+        """Read key from data received from related units.
+
+        Reads are recorded as ``received_read`` when metrics are enabled.
+        The data is read from the relations at the start of the hook, so this
+        counts reads of the received data rather than calls to relation-get.
+
+        :param key: Relation data key.
+        :type key: str
+        :param units: Unit or units to read from, by default the combined
+                      data of all joined units.
+        :type units: Optional[Union[charms.reactive.endpoints.RelatedUnit,
+                                    charms.reactive.endpoints.CombinedUnitsView]]
+        """
+        if units is None:
+            return self._call('received_read',
+                              self.all_joined_units.received.__getitem__, key)
+        return self._call('received_read', units.received.get, key)
+
+    def _unpublish(self, relation, key):
+        """Remove key from relation unless it is not published."""
+        if relation.to_publish_raw.get(key) is not None:
+            self._call('published_write', relation.to_publish_raw.__setitem__,
+                       key, None)
+
+    def _publish_raw(self, relation, key, value):
+        """Publish raw key on relation unless it already has the value."""
+        if relation.to_publish_raw.get(key) == value:
+            return
+        self._call('published_write', relation.to_publish_raw.__setitem__,
+                   key, value)
+
+    def _publish(self, relation, key, value):
+        """Publish key on relation unless it already has the same value."""
+        if relation.to_publish_raw.get(key) == json.dumps(value,
+                                                          sort_keys=True):
+            return
+        self._call('published_write', relation.to_publish.__setitem__, key,
+                   value)
+
+
+def _is_create_pool_op(op):
+    return op.get('op') == 'create-pool'
+
+
+def fan_out_broker_requests(source, targets, op_filter=_is_create_pool_op):
+    """Send operations of broker requests received on one endpoint to others.
+
+    The rbd-mirror charm maintains a single collapsed broker request holding
+    the operations of all broker requests known to the ceph-mon of the local
+    cluster with the ceph-mon of each remote cluster.  The received broker
+    requests are processed in one pass, and the operations, their digest and
+    index are shared by all targets, so a target where the request was
+    already sent costs a digest lookup.  Requests are published through
+    ``batch_publish`` on every target.
+
+    :param source: Endpoint receiving broker requests.
+    :type source: CephRBDMirrorRequires
+    :param targets: Endpoints to maintain the collapsed request with.
+    :type targets: Iterable[CephRBDMirrorRequires]
+    :param op_filter: Called with each operation, return True to include it.
+                      Defaults to including ``create-pool`` operations.
+    :type op_filter: Callable[[Dict[str, Any]], bool]
+    :returns: Operations of the collapsed request.
+    :rtype: List[Dict[str, Any]]
+    """
+    ops = []
+    seen = set()
+    for request in source.broker_requests:
+        for op in request.get('ops', []):
+            if not op_filter(op):
+                continue
+            key = json.dumps(op, sort_keys=True)
+            if key not in seen:
+                seen.add(key)
+                ops.append(op)
+    digest = _ops_digest(ops)
+    # built by the first target needing it and shared with the others
+    rq_index = None
+
+    def get_rq():
+        rq = ch_ceph.CephBrokerRq()
+        rq.set_ops(list(ops))
+        return rq
+
+    with contextlib.ExitStack() as stack:
+        for target in targets:
+            stack.enter_context(target.batch_publish())
+            rq_index = target._maybe_send_ops(ops, digest, get_rq, rq_index)
+    return ops
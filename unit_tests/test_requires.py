@@ -49,6 +49,7 @@ class TestCephRBDMirrorRequires(test_utils.PatchHelper):
         super().setUp()
         self.requires_class = requires.CephRBDMirrorRequires(
             'some-endpoint', [], unique_id='some-hostname')
+        requires._reset_hook_state()
         self._patches = {}
         self._patches_start = {}
 
@@ -85,7 +86,9 @@ class TestCephRBDMirrorRequires(test_utils.PatchHelper):
         self.patch_object(requires, 'all_flags_set')
         self.patch_object(requires, 'clear_flag')
         self.patch_object(requires, 'set_flag')
+        self.patch_object(requires, 'get_flags')
         self.all_flags_set.return_value = True
+        self.get_flags.return_value = []
         self.requires_class.changed()
         self.all_flags_set.assert_called_with(
             'endpoint.some-endpoint.changed.auth',
@@ -99,6 +102,65 @@ class TestCephRBDMirrorRequires(test_utils.PatchHelper):
         ])
         self.set_flag.assert_called_once_with('some-endpoint.available')
 
+    def test_changed_flags(self):
+        self.patch_object(requires, 'all_flags_set')
+        self.patch_object(requires, 'clear_flag')
+        self.patch_object(requires, 'set_flag')
+        self.patch_object(requires, 'get_flags')
+        self.all_flags_set.return_value = False
+        flags = [
+            'endpoint.some-endpoint.changed.ceph-public-address',
+            'endpoint.some-endpoint.changed.pools-delta',
+        ]
+        self.get_flags.return_value = flags
+        self.requires_class.changed()
+        self.set_flag.assert_has_calls([
+            mock.call('some-endpoint.mon_hosts.changed'),
+            mock.call('some-endpoint.networks.changed'),
+            mock.call('some-endpoint.pools.changed'),
+        ])
+        self.assertEqual(self.set_flag.call_count, 3)
+        # flags required for availability are kept until it is reached
+        self.clear_flag.assert_called_once_with(
+            'endpoint.some-endpoint.changed.pools-delta')
+        # flags required for availability are read before they are cleared
+        self.all_flags_set.return_value = True
+        self.set_flag.reset_mock()
+        flags[:] = [
+            'endpoint.some-endpoint.changed.auth',
+            'endpoint.some-endpoint.changed.some-hostname_key',
+            'endpoint.some-endpoint.changed.ceph-public-address',
+        ]
+        self.requires_class.changed()
+        self.set_flag.assert_has_calls([
+            mock.call('some-endpoint.available'),
+            mock.call('some-endpoint.key.changed'),
+            mock.call('some-endpoint.key.changed'),
+            mock.call('some-endpoint.mon_hosts.changed'),
+            mock.call('some-endpoint.networks.changed'),
+        ])
+
+    def test_changed_flags_hooks(self):
+        flags = set()
+        self.patch_object(requires, 'get_flags',
+                          side_effect=lambda: sorted(flags))
+        self.patch_object(requires, 'set_flag', side_effect=flags.add)
+        self.patch_object(requires, 'clear_flag', side_effect=flags.discard)
+        self.patch_object(requires, 'all_flags_set',
+                          side_effect=lambda *names: flags.issuperset(names))
+        # first hook, the ceph-mon published pools
+        flags.update(['some-endpoint.available',
+                      'endpoint.some-endpoint.changed',
+                      'endpoint.some-endpoint.changed.pools'])
+        self.requires_class.changed()
+        self.assertIn('some-endpoint.pools.changed', flags)
+        self.assertNotIn('endpoint.some-endpoint.changed.pools', flags)
+        # a handler processes the change
+        flags.discard('some-endpoint.pools.changed')
+        # next hook, no data changed
+        self.requires_class.changed()
+        self.assertNotIn('some-endpoint.pools.changed', flags)
+
     def test_broken(self):
         self.patch_object(requires, 'clear_flag')
         self.requires_class.broken()
@@ -107,74 +169,308 @@ class TestCephRBDMirrorRequires(test_utils.PatchHelper):
             mock.call('some-endpoint.connected'),
         ])
 
+    def test_unique_id(self):
+        self.patch_object(requires.socket, 'gethostname')
+        self.gethostname.return_value = 'juju-1a2b3c-0'
+        self.patch_object(requires, '_hostname')
+        requires._hostname = None
+        endpoint = requires.CephRBDMirrorRequires('some-endpoint', [])
+        self.assertFalse(self.gethostname.called)
+        self.assertEqual(endpoint.unique_id, 'juju-1a2b3c-0')
+        self.assertEqual(endpoint.key_name, 'juju-1a2b3c-0_key')
+        endpoint = requires.CephRBDMirrorRequires('other-endpoint', [])
+        self.assertEqual(endpoint.unique_id, 'juju-1a2b3c-0')
+        self.gethostname.assert_called_once_with()
+        self.assertEqual(self.requires_class.key_name, 'some-hostname_key')
+        # both can still be assigned
+        endpoint.unique_id = 'other-id'
+        self.assertEqual(endpoint.unique_id, 'other-id')
+        self.assertEqual(endpoint.key_name, 'other-id_key')
+        endpoint.key_name = 'some-key'
+        self.assertEqual(endpoint.key_name, 'some-key')
+
+    def test_lazy_module(self):
+        self.patch_object(requires.importlib, 'import_module')
+        module = mock.MagicMock()
+        module.attr = 'value'
+        self.import_module.return_value = module
+        lazy = requires._LazyModule('some.module')
+        self.assertFalse(self.import_module.called)
+        self.assertEqual(lazy.attr, 'value')
+        lazy.attr = 'other'
+        self.assertEqual(module.attr, 'other')
+        del lazy.attr
+        self.assertFalse(hasattr(module, 'attr'))
+        self.import_module.assert_called_once_with('some.module')
+
     def test_request_key(self):
+        db = mock.MagicMock()
+        db.get.return_value = None
+        self.patch_object(requires.ch_unitdata, 'kv', return_value=db)
         to_publish = self.patch_topublish()
         self.requires_class.request_key()
         to_publish.__setitem__.assert_called_with('unique_id', 'some-hostname')
 
+    def test_request_key_received(self):
+        db = mock.MagicMock()
+        db.get.return_value = {'key_name': 'some-hostname_key',
+                               'relations': ['some-endpoint:42']}
+        self.patch_object(requires.ch_unitdata, 'kv', return_value=db)
+        self.patch_requires_class('_relations')
+        relation = mock.MagicMock()
+        relation.relation_id = 'some-endpoint:42'
+        new_relation = mock.MagicMock()
+        new_relation.relation_id = 'some-endpoint:43'
+        self._relations.__iter__.return_value = [relation, new_relation]
+        self.requires_class.request_key()
+        self.assertFalse(relation.to_publish.__setitem__.called)
+        new_relation.to_publish.__setitem__.assert_called_once_with(
+            'unique_id', 'some-hostname')
+        # a key recorded for another unique_id is not valid
+        db.get.return_value = {'key_name': 'other_key',
+                               'relations': ['some-endpoint:42']}
+        self.requires_class._key_record = None
+        self.requires_class.request_key()
+        relation.to_publish.__setitem__.assert_called_once_with(
+            'unique_id', 'some-hostname')
+
+    def test_key_material(self):
+        db = mock.MagicMock()
+        db.get.return_value = None
+        self.patch_object(requires.ch_unitdata, 'kv', return_value=db)
+        self.patch_requires_class('_all_joined_units')
+        received = {'auth': 'cephx', 'some-hostname_key': 'AQBkey=='}
+        self._all_joined_units.received.__getitem__.side_effect = (
+            received.get)
+        self.patch_requires_class('_relations')
+        relation = mock.MagicMock()
+        relation.relation_id = 'some-endpoint:42'
+        relation.joined_units.received = received
+        self._relations.__iter__.return_value = [relation]
+        self.assertEqual(self.requires_class.key, 'AQBkey==')
+        self.assertEqual(self.requires_class.auth, 'cephx')
+        fingerprint = self.requires_class.key_fingerprint
+        self.assertTrue(fingerprint)
+        self.assertEqual(
+            self._all_joined_units.received.__getitem__.call_count, 2)
+        db.set.assert_called_once_with(
+            'ceph-rbd-mirror.some-endpoint.key', {
+                'key_name': 'some-hostname_key',
+                'fingerprint': fingerprint,
+                'auth': 'cephx',
+                'key': 'AQBkey==',
+                'relations': ['some-endpoint:42'],
+            })
+        # nothing is written when the recorded key is unchanged
+        db.get.return_value = db.set.call_args[0][1]
+        db.set.reset_mock()
+        self.requires_class = requires.CephRBDMirrorRequires(
+            'some-endpoint', [], unique_id='some-hostname')
+        self.patch_requires_class('_all_joined_units')
+        self._all_joined_units.received.__getitem__.side_effect = (
+            received.get)
+        self.patch_requires_class('_relations')
+        self._relations.__iter__.return_value = [relation]
+        self.assertEqual(self.requires_class.key_fingerprint, fingerprint)
+        self.assertFalse(db.set.called)
+        # a revoked key is forgotten
+        received['some-hostname_key'] = None
+        self.requires_class._key_material = None
+        self.assertEqual(self.requires_class.key_fingerprint, None)
+        db.set.assert_called_once_with(
+            'ceph-rbd-mirror.some-endpoint.key', {})
+
     def test_create_replicated_pool(self):
         self.patch_requires_class('_relations')
         relation = mock.MagicMock()
         relation.relation_id = 'some-endpoint:42'
         self._relations.__iter__.return_value = [relation]
-        self.patch_object(requires.ch_ceph, 'get_previous_request')
+        self.patch_requires_class('_read_previous_request')
         broker_req = mock.MagicMock()
         broker_req.ops = [{'op': 'create-pool', 'name': 'rbd'}]
-        self.get_previous_request.return_value = broker_req
+        self._read_previous_request.return_value = broker_req
         self.requires_class.create_replicated_pool('rbd')
         self.assertFalse(broker_req.add_op_create_replicated_pool.called)
-        self.get_previous_request.return_value = None
+        self.requires_class._reset_request_cache()
+        self._read_previous_request.return_value = None
         self.patch_object(requires.ch_ceph, 'CephBrokerRq')
         self.CephBrokerRq.return_value = broker_req
         self.requires_class.create_replicated_pool('rbd')
         self.CephBrokerRq.assert_called_with()
         self.assertFalse(broker_req.add_op_create_replicated_pool.called)
+        self.requires_class._reset_request_cache()
         broker_req = mock.MagicMock()
         self.CephBrokerRq.return_value = broker_req
-        self.patch_object(requires.ch_ceph, 'send_request_if_needed')
+        self.patch_requires_class('_publish_request')
         self.requires_class.create_replicated_pool('rbd')
         broker_req.add_op_create_replicated_pool.assert_called_once_with(
             app_name=None, group=None, max_bytes=None, max_objects=None,
             name='rbd', namespace=None, pg_num=None, replica_count=3,
             weight=None)
-        self.send_request_if_needed.assert_called_once_with(
-            broker_req,
-            relation='some-endpoint')
+        self._publish_request.assert_called_once_with(broker_req)
 
     def test_create_erasure_pool(self):
         self.patch_requires_class('_relations')
         relation = mock.MagicMock()
         relation.relation_id = 'some-endpoint:42'
         self._relations.__iter__.return_value = [relation]
-        self.patch_object(requires.ch_ceph, 'get_previous_request')
+        self.patch_requires_class('_read_previous_request')
         broker_req = mock.MagicMock()
         broker_req.ops = [{'op': 'create-pool', 'name': 'rbd'}]
-        self.get_previous_request.return_value = broker_req
+        self._read_previous_request.return_value = broker_req
         self.requires_class.create_erasure_pool('rbd')
         self.assertFalse(broker_req.add_op_create_erasure_pool.called)
-        self.get_previous_request.return_value = None
+        self.requires_class._reset_request_cache()
+        self._read_previous_request.return_value = None
         self.patch_object(requires.ch_ceph, 'CephBrokerRq')
         self.CephBrokerRq.return_value = broker_req
         self.requires_class.create_erasure_pool('rbd')
         self.CephBrokerRq.assert_called_with()
         self.assertFalse(broker_req.add_op_create_erasure_pool.called)
+        self.requires_class._reset_request_cache()
         broker_req = mock.MagicMock()
         self.CephBrokerRq.return_value = broker_req
-        self.patch_object(requires.ch_ceph, 'send_request_if_needed')
+        self.patch_requires_class('_publish_request')
         self.requires_class.create_erasure_pool('rbd')
         broker_req.add_op_create_erasure_pool.assert_called_once_with(
             app_name=None, erasure_profile=None, group=None, max_bytes=None,
             max_objects=None, name='rbd', weight=None)
-        self.send_request_if_needed.assert_called_once_with(
-            broker_req,
-            relation='some-endpoint')
+        self._publish_request.assert_called_once_with(broker_req)
+
+    def test_create_pools(self):
+        self.patch_requires_class('_relations')
+        relation = mock.MagicMock()
+        relation.relation_id = 'some-endpoint:42'
+        self._relations.__iter__.return_value = [relation]
+        self.patch_requires_class('_read_previous_request')
+        self.patch_requires_class('_publish_request')
+        broker_req = mock.MagicMock()
+        broker_req.ops = [{'op': 'create-pool', 'name': 'rbd'}]
+        self._read_previous_request.return_value = broker_req
+        self.requires_class.create_pools([
+            {'name': 'rbd'},
+            {'name': 'images', 'replicas': '2', 'app_name': 'rbd'},
+            {'name': 'ec', 'pool_type': 'erasure',
+             'erasure_profile': 'jerasure', 'weight': '10'},
+        ])
+        self._read_previous_request.assert_called_once_with('some-endpoint:42')
+        broker_req.add_op_create_replicated_pool.assert_called_once_with(
+            app_name='rbd', group=None, max_bytes=None, max_objects=None,
+            name='images', namespace=None, pg_num=None, replica_count=2,
+            weight=None)
+        broker_req.add_op_create_erasure_pool.assert_called_once_with(
+            app_name=None, erasure_profile='jerasure', group=None,
+            max_bytes=None, max_objects=None, name='ec', weight=10.0)
+        self._publish_request.assert_called_once_with(broker_req)
+        self._publish_request.reset_mock()
+        self.requires_class.create_pools([{'name': 'rbd'}])
+        self.assertFalse(self._publish_request.called)
+        # the previous request is cached for the duration of the hook
+        self._read_previous_request.assert_called_once_with('some-endpoint:42')
+        self.patch_object(requires, 'all_flags_set')
+        self.all_flags_set.return_value = False
+        self.requires_class.changed()
+        self.requires_class.create_pools([{'name': 'rbd'}])
+        self.assertEqual(self._read_previous_request.call_count, 2)
+        with self.assertRaises(ValueError):
+            self.requires_class.create_pools([
+                {'name': 'rbd', 'pool_type': 'bogus'}])
 
     def test_refresh_pools(self):
         self.patch_object(requires.uuid, 'uuid4')
         self.uuid4.return_value = 'FAKE-UUID'
-        to_publish = self.patch_topublish()
+        self.patch_requires_class('_relations')
+        relation = mock.MagicMock()
+        relation.to_publish_raw = {}
+        self._relations.__iter__.return_value = [relation]
+        self.requires_class.refresh_pools(names=['b', 'a', 'b'], since=42)
+        relation.to_publish.__setitem__.assert_has_calls([
+            mock.call('refresh-pools', ['a', 'b']),
+            mock.call('pools-since', 42),
+            mock.call('nonce', 'FAKE-UUID'),
+        ])
+        relation.to_publish.__setitem__.reset_mock()
+        relation.to_publish_raw = {'refresh-pools': '["a", "b"]',
+                                   'pools-since': '42'}
         self.requires_class.refresh_pools()
-        to_publish.__setitem__.assert_called_with('nonce', 'FAKE-UUID')
+        # keys for arguments not given are removed rather than set to null
+        relation.to_publish.__setitem__.assert_called_once_with(
+            'nonce', 'FAKE-UUID')
+        self.assertEqual(relation.to_publish_raw, {'refresh-pools': None,
+                                                   'pools-since': None})
+
+    def test_pool_index(self):
+        self.patch_requires_class('_all_joined_units')
+        received = {'pools': {
+            'rbd': {'applications': {'rbd': {}},
+                    'parameters': {'size': 3}},
+            'ec': {'applications': {'rbd': {}, 'rgw': {}},
+                   'parameters': {'erasure_code_profile': 'jerasure'}},
+            'unused': {},
+        }}
+        self._all_joined_units.received.__getitem__.side_effect = (
+            lambda key: received.get(key))
+        index = self.requires_class.pool_index
+        self.assertEqual(index.by_name, received['pools'])
+        self.assertEqual(index.by_app, {'rbd': ['ec', 'rbd'], 'rgw': ['ec']})
+        self.assertEqual(index.by_type, {'erasure': ['ec'],
+                                         'replicated': ['rbd', 'unused']})
+        self.assertIs(self.requires_class.pool_index, index)
+        self.patch_object(requires, 'all_flags_set')
+        self.all_flags_set.return_value = False
+        self.requires_class.changed()
+        self.assertIsNot(self.requires_class.pool_index, index)
+
+    def test_pools(self):
+        self.patch_requires_class('_all_joined_units')
+        received = {'pools': {'rbd': {}}}
+        self._all_joined_units.received.__getitem__.side_effect = (
+            lambda key: received.get(key))
+        self.assertEqual(self.requires_class.pools, {'rbd': {}})
+        db = mock.MagicMock()
+        db.get.return_value = {
+            'generation': 1, 'pools': {'rbd': {}, 'old': {}}}
+        self.patch_object(requires.ch_unitdata, 'kv', return_value=db)
+        received['pools-delta'] = {
+            'generation': 2, 'since': 1,
+            'pools': {'new': {'parameters': {'size': 3}}},
+            'removed': ['old'],
+        }
+        expect = {'rbd': {}, 'new': {'parameters': {'size': 3}}}
+        self.assertEqual(self.requires_class.pools, expect)
+        db.set.assert_called_once_with(
+            'ceph-rbd-mirror.some-endpoint.pools',
+            {'generation': 2, 'pools': expect})
+        self.assertEqual(self.requires_class.pools_generation, 2)
+        # a merged delta is not merged again
+        self.assertEqual(self.requires_class.pools, expect)
+        db.get.assert_called_once_with('ceph-rbd-mirror.some-endpoint.pools')
+        # a delta that does not apply drops the local pool map, requests a
+        # full pool map once and falls back to the full list of pools
+        self.patch_requires_class('refresh_pools')
+        self.requires_class._merged_pools = None
+        received['pools-delta'] = {'generation': 4, 'since': 3, 'pools': {}}
+        self.assertEqual(self.requires_class.pools, {'rbd': {}})
+        db.unset.assert_called_once_with('ceph-rbd-mirror.some-endpoint.pools')
+        self.refresh_pools.assert_called_once_with()
+        refresh = db.set.call_args[0]
+        self.assertEqual(refresh[0],
+                         'ceph-rbd-mirror.some-endpoint.pools_refresh')
+        db.get.side_effect = lambda key: {
+            refresh[0]: refresh[1]}.get(key)
+        self.assertEqual(self.requires_class.pools, {'rbd': {}})
+        self.refresh_pools.assert_called_once_with()
+        # a malformed delta does not apply either
+        received['pools-delta'] = {'since': 3, 'pools': {}}
+        self.assertEqual(self.requires_class.pools, {'rbd': {}})
+        self.assertEqual(self.refresh_pools.call_count, 2)
+        received['pools-delta'] = ['not', 'a', 'delta']
+        self.assertEqual(self.requires_class.pools, {'rbd': {}})
+        self.assertEqual(self.refresh_pools.call_count, 3)
+        # a full pool map replaces the local pool map
+        received['pools-delta'] = {
+            'generation': 5, 'since': None, 'pools': {'other': {}}}
+        self.assertEqual(self.requires_class.pools, {'other': {}})
 
     def test_mon_hosts(self):
         self.patch_requires_class('_relations')
@@ -187,11 +483,35 @@ class TestCephRBDMirrorRequires(test_utils.PatchHelper):
         unitv6.received = {'ceph-public-address': '2001:db8:42::1'}
         unitv4 = mock.MagicMock()
         unitv4.received = {'ceph-public-address': '192.0.2.1'}
+        unitv4_dup = mock.MagicMock()
+        unitv4_dup.received = {'ceph-public-address': '192.0.2.1'}
+        unitv4_low = mock.MagicMock()
+        unitv4_low.received = {'ceph-public-address': '192.0.2.0'}
         relation.units.__iter__.return_value = [unit_incomplete, unitv6,
-                                                unit_invalid, unitv4]
+                                                unit_invalid, unitv4,
+                                                unitv4_dup, unitv4_low]
         self._relations.__iter__.return_value = [relation]
+        self.patch_object(requires.ipaddress, 'ip_address',
+                          side_effect=requires.ipaddress.ip_address)
+        self.assertEqual(list(self.requires_class.mon_hosts()),
+                         ['192.0.2.0:6789', '192.0.2.1:6789',
+                          '[2001:db8:42::1]:6789'])
+        self.assertEqual(self.ip_address.call_count, 6)
+        self.assertEqual(
+            list(self.requires_class.mon_hosts(port=requires.MSGR2_PORT)),
+            ['192.0.2.0:3300', '192.0.2.1:3300', '[2001:db8:42::1]:3300'])
+        self.assertEqual(
+            list(self.requires_class.mon_hosts(addrvec=True)),
+            ['[v2:192.0.2.0:3300,v1:192.0.2.0:6789]',
+             '[v2:192.0.2.1:3300,v1:192.0.2.1:6789]',
+             '[v2:[2001:db8:42::1]:3300,v1:[2001:db8:42::1]:6789]'])
+        # addresses are only parsed again when they change
+        self.assertEqual(self.ip_address.call_count, 6)
+        unitv4_low.received = {'ceph-public-address': '192.0.2.2'}
         self.assertEqual(list(self.requires_class.mon_hosts()),
-                         ['[2001:db8:42::1]:6789', '192.0.2.1:6789'])
+                         ['192.0.2.1:6789', '192.0.2.2:6789',
+                          '[2001:db8:42::1]:6789'])
+        self.assertEqual(self.ip_address.call_count, 12)
 
     def test_public_network(self):
         self.patch_requires_class('_all_joined_units')
@@ -202,8 +522,12 @@ class TestCephRBDMirrorRequires(test_utils.PatchHelper):
         self._all_joined_units.received.__getitem__.assert_called_once_with(
             'ceph-public-address')
         self.resolve_network_cidr.assert_called_once_with('192.0.2.1')
+        # the network for an address is only resolved once
+        self.assertEqual(self.requires_class.public_network, '192.0.2.0/24')
+        self.resolve_network_cidr.assert_called_once_with('192.0.2.1')
 
         # Test no netmask condition
+        self._all_joined_units.received.__getitem__.return_value = '192.0.2.2'
         self.resolve_network_cidr.side_effect = AddrFormatError()
         self.assertEqual(self.requires_class.public_network, None)
 
@@ -216,19 +540,145 @@ class TestCephRBDMirrorRequires(test_utils.PatchHelper):
         self._all_joined_units.received.__getitem__.assert_called_once_with(
             'ceph-cluster-address')
         self.resolve_network_cidr.assert_called_once_with('192.0.2.1')
+        # the network for an address is only resolved once
+        self.assertEqual(self.requires_class.cluster_network, '192.0.2.0/24')
+        self.resolve_network_cidr.assert_called_once_with('192.0.2.1')
 
         # Test no netmask condition
+        self._all_joined_units.received.__getitem__.return_value = '192.0.2.2'
         self.resolve_network_cidr.side_effect = AddrFormatError()
         self.assertEqual(self.requires_class.cluster_network, None)
 
     def test_maybe_send_rq(self):
         self.patch_requires_class('_relations')
         relation = mock.MagicMock()
+        relation.relation_id = 'some-endpoint:42'
+        relation.to_publish_raw = {'broker_req': '{"ops": []}'}
+        self._relations.__iter__.return_value = [relation]
+        self.patch_requires_class('_read_previous_request')
+        self.patch_requires_class('_publish_request')
+        previous_rq = mock.MagicMock()
+        previous_rq.ops = [{'op': 'create-pool', 'name': 'rbd'}]
+        self._read_previous_request.return_value = previous_rq
+        db = mock.MagicMock()
+        db.get.return_value = {}
+        self.patch_object(requires.ch_unitdata, 'kv', return_value=db)
+        self.patch_object(requires.ch_ceph, 'CephBrokerRq',
+                          return_value=mock.MagicMock(ops=[]))
+        rq = mock.MagicMock()
+        rq.ops = [{'op': 'create-pool', 'name': 'rbd'},
+                  {'op': 'create-pool', 'name': 'images'}]
+        self.requires_class.maybe_send_rq(rq)
+        self._read_previous_request.assert_called_once_with('some-endpoint:42')
+        # a copy of the request is sent and cached, not the caller's object
+        self.CephBrokerRq.assert_called_once_with(raw_request_data=rq.request)
+        self._publish_request.assert_called_once_with(
+            self.CephBrokerRq.return_value)
+        self.assertIs(
+            self.requires_class._previous_requests['some-endpoint:42'],
+            self.CephBrokerRq.return_value)
+        db.set.assert_called_once_with(
+            'ceph-rbd-mirror.some-endpoint.sent_digests',
+            {'some-endpoint:42': [mock.ANY, mock.ANY]})
+        digest = db.set.call_args[0][1]['some-endpoint:42']
+        # the digest of what was sent is persisted, so sending the same
+        # request again in a later hook is a no-op
+        db.get.return_value = {'some-endpoint:42': digest}
+        self.requires_class = requires.CephRBDMirrorRequires(
+            'some-endpoint', [], unique_id='some-hostname')
+        self.patch_requires_class('_relations')
+        self._relations.__iter__.return_value = [relation]
+        self.patch_requires_class('_read_previous_request')
+        self.patch_requires_class('_publish_request')
+        self.requires_class.maybe_send_rq(rq)
+        self.assertFalse(self._read_previous_request.called)
+        self.assertFalse(self._publish_request.called)
+        # the digest is not trusted when the request published on the
+        # relation has changed since it was recorded
+        relation.to_publish_raw = {'broker_req': '{"ops": [1]}'}
+        self.requires_class.maybe_send_rq(rq)
+        self._publish_request.assert_called_once_with(
+            self.CephBrokerRq.return_value)
+        relation.to_publish_raw = {'broker_req': '{"ops": []}'}
+        self._publish_request.reset_mock()
+        self._read_previous_request.reset_mock()
+        self.requires_class._previous_requests.clear()
+        self.requires_class._op_indexes.clear()
+        # a relation already holding the same operations is not sent to
+        db.get.return_value = {}
+        db.set.reset_mock()
+        self.requires_class._sent_digests = None
+        self._read_previous_request.return_value = rq
+        self.requires_class.maybe_send_rq(rq)
+        self._read_previous_request.assert_called_once_with('some-endpoint:42')
+        self.assertFalse(self._publish_request.called)
+        db.set.assert_called_once_with(
+            'ceph-rbd-mirror.some-endpoint.sent_digests',
+            {'some-endpoint:42': digest})
+
+    def test_maybe_send_rq_changed_op(self):
+
+        class FakeRq(object):
+
+            def __init__(self, raw_request_data=None):
+                self.ops = []
+                if raw_request_data:
+                    self.ops = json.loads(raw_request_data)['ops']
+
+            @property
+            def request(self):
+                return json.dumps({'ops': self.ops})
+
+        self.patch_requires_class('_relations')
+        relation = mock.MagicMock()
+        relation.relation_id = 'some-endpoint:42'
+        relation.to_publish_raw = {}
+        self._relations.__iter__.return_value = [relation]
+        self.patch_requires_class('_read_previous_request')
+        self.patch_requires_class('_publish_request')
+        self.patch_object(requires.ch_ceph, 'CephBrokerRq', side_effect=FakeRq)
+        db = mock.MagicMock()
+        db.get.return_value = {}
+        self.patch_object(requires.ch_unitdata, 'kv', return_value=db)
+        rq = FakeRq()
+        rq.ops = [{'op': 'create-pool', 'name': 'rbd', 'replicas': 3}]
+        self.requires_class.maybe_send_rq(rq)
+        self.assertEqual(self._publish_request.call_count, 1)
+        # changing an operation of the caller's request after sending it
+        # does not change what is remembered as sent
+        rq.ops[0]['replicas'] = 2
+        self.requires_class.maybe_send_rq(rq)
+        self.assertEqual(self._publish_request.call_count, 2)
+        self.assertEqual(self._publish_request.call_args[0][0].ops,
+                         [{'op': 'create-pool', 'name': 'rbd',
+                           'replicas': 2}])
+        # nothing is indexed when the digest matches
+        self.patch_requires_class('_build_op_index')
+        self.requires_class.maybe_send_rq(rq)
+        self.assertEqual(self._publish_request.call_count, 2)
+        self.assertFalse(self._build_op_index.called)
+
+    def test_maybe_send_rq_previous_not_indexed(self):
+        self.patch_requires_class('_relations')
+        relation = mock.MagicMock()
+        relation.relation_id = 'some-endpoint:42'
+        relation.to_publish_raw = {}
         self._relations.__iter__.return_value = [relation]
-        self.patch_object(requires.ch_ceph, 'send_request_if_needed')
-        self.requires_class.maybe_send_rq('aRq')
-        self.send_request_if_needed.assert_called_once_with(
-            'aRq', relation='some-endpoint')
+        self.patch_requires_class('_read_previous_request')
+        self.patch_requires_class('_publish_request')
+        db = mock.MagicMock()
+        db.get.return_value = {}
+        self.patch_object(requires.ch_unitdata, 'kv', return_value=db)
+        previous_rq = mock.MagicMock()
+        previous_rq.ops = [{'op': 'create-pool', 'name': 'rbd'},
+                           {'op': 'set-key-permissions'}]
+        self._read_previous_request.return_value = previous_rq
+        self.patch_object(requires.ch_ceph, 'CephBrokerRq')
+        rq = mock.MagicMock()
+        rq.ops = [{'op': 'create-pool', 'name': 'rbd'}]
+        self.requires_class.maybe_send_rq(rq)
+        self._publish_request.assert_called_once_with(
+            self.CephBrokerRq.return_value)
 
     def test_broker_requests(self):
         self.patch_requires_class('_all_joined_units')
@@ -240,9 +690,548 @@ class TestCephRBDMirrorRequires(test_utils.PatchHelper):
         for rq in self.requires_class.broker_requests:
             self.assertIn(rq['fakereq'], (0, 1))
         self._all_joined_units.received.__contains__.return_value = False
+        self.requires_class._broker_requests = None
         with self.assertRaises(StopIteration):
             next(self.requires_class.broker_requests)
         self._all_joined_units.received.__contains__.return_value = True
         self._all_joined_units.received.__getitem__.return_value = None
+        self.requires_class._broker_requests = None
         with self.assertRaises(StopIteration):
             next(self.requires_class.broker_requests)
+
+    def test_broker_requests_cached(self):
+        self.patch_requires_class('_all_joined_units')
+        self._all_joined_units.received.__contains__.return_value = True
+        self._all_joined_units.received.__getitem__.return_value = [
+            json.dumps({'request-id': 'a', 'ops': []}),
+            json.dumps({'request-id': 'b', 'ops': []}),
+        ]
+        loads = mock.patch.object(requires.json, 'loads', wraps=json.loads)
+        self.loads = loads.start()
+        self.addCleanup(loads.stop)
+        self.assertEqual(len(list(self.requires_class.broker_requests)), 2)
+        self.assertEqual(len(list(self.requires_class.broker_requests)), 2)
+        self.assertEqual(self.loads.call_count, 2)
+        self.assertEqual(self.requires_class.get_broker_request('b'),
+                         {'request-id': 'b', 'ops': []})
+        self.assertEqual(self.requires_class.get_broker_request('c'), None)
+        # the relation data is only read once until changed
+        self._all_joined_units.received.__getitem__.assert_called_once_with(
+            'broker_requests')
+        self._all_joined_units.received.__getitem__.return_value = [
+            json.dumps({'request-id': 'a', 'ops': []}),
+            json.dumps({'request-id': 'c', 'ops': []}),
+        ]
+        self.assertEqual(self.requires_class.get_broker_request('c'), None)
+        self.patch_object(requires, 'all_flags_set', return_value=False)
+        self.patch_object(requires, 'get_flags', return_value=[])
+        self.requires_class.changed()
+        self.assertEqual(self.requires_class.get_broker_request('b'), None)
+        self.assertEqual(self.requires_class.get_broker_request('c'),
+                         {'request-id': 'c', 'ops': []})
+        self.assertEqual(self.loads.call_count, 3)
+
+    def test_broker_requests_delta(self):
+        self.patch_requires_class('_all_joined_units')
+        self._all_joined_units.received.__contains__.return_value = True
+        op_a = {'op': 'create-pool', 'name': 'a'}
+        op_b = {'op': 'create-pool', 'name': 'b'}
+        op_c = {'op': 'create-pool', 'name': 'c'}
+        self._all_joined_units.received.__getitem__.return_value = [
+            json.dumps({'request-id': 'rq1', 'ops': [op_a]}),
+            json.dumps({'request-id': 'rq2', 'ops': [op_b, op_c]}),
+            json.dumps({'request-id': 'rq3', 'ops': [op_c]}),
+        ]
+        db = mock.MagicMock()
+        self.patch_object(requires.ch_unitdata, 'kv', return_value=db)
+        db.get.return_value = {
+            'rq0': {'request-id': 'rq0', 'ops': [op_b]},
+            'rq1': {'request-id': 'rq1', 'ops': [op_a]},
+            'rq2': {'request-id': 'rq2', 'ops': [op_b]},
+        }
+        expect = {
+            'added': [{'request-id': 'rq3', 'ops': [op_c]}],
+            'removed': [{'request-id': 'rq0', 'ops': [op_b]}],
+            'changed': [{'request-id': 'rq2', 'ops': [op_b, op_c]}],
+            'ops_added': [op_c],
+            'ops_removed': [],
+        }
+        self.assertEqual(self.requires_class.broker_requests_delta(), expect)
+        db.get.assert_called_once_with(
+            'ceph-rbd-mirror.some-endpoint.broker_requests')
+        db.set.assert_called_once_with(
+            'ceph-rbd-mirror.some-endpoint.broker_requests', {
+                'rq1': {'request-id': 'rq1', 'ops': [op_a]},
+                'rq2': {'request-id': 'rq2', 'ops': [op_b, op_c]},
+                'rq3': {'request-id': 'rq3', 'ops': [op_c]},
+            })
+        # the delta is computed once per hook
+        self.assertEqual(self.requires_class.broker_requests_delta(), expect)
+        db.get.assert_called_once_with(
+            'ceph-rbd-mirror.some-endpoint.broker_requests')
+
+    def test_metrics(self):
+        self.patch_requires_class('_all_joined_units')
+        self._all_joined_units.received.__contains__.return_value = True
+        self._all_joined_units.received.__getitem__.return_value = [
+            json.dumps({'request-id': 'a', 'ops': []}),
+        ]
+        self.patch_object(requires.ch_hookenv, 'hook_name',
+                          return_value='update-status')
+        self.patch_object(requires.ch_hookenv, 'log')
+        self.assertEqual(self.requires_class.metrics_summary(), {
+            'endpoint': 'some-endpoint',
+            'hook': 'update-status',
+            'calls': {},
+        })
+        list(self.requires_class.broker_requests)
+        self.assertEqual(self.requires_class.metrics, None)
+        self.requires_class.enable_metrics()
+        self.requires_class._broker_request_cache.clear()
+        self.requires_class._broker_requests = None
+        list(self.requires_class.broker_requests)
+        summary = self.requires_class.metrics_summary()
+        self.assertEqual(
+            {name: calls['count'] for name, calls in summary['calls'].items()},
+            {'json_loads': 1, 'received_read': 1})
+        # reads of data received from individual units are counted as well
+        relation = mock.MagicMock()
+        unit = mock.MagicMock()
+        unit.received = {'broker-features': ['broker-req-chunks']}
+        relation.units = [unit, unit]
+        self.assertTrue(self.requires_class._remote_supports(
+            relation, 'broker-features', 'broker-req-chunks'))
+        self.assertEqual(
+            self.requires_class.metrics_summary()['calls']['received_read'][
+                'count'], 3)
+        # sending a broker request is recorded as a whole
+        self.patch_requires_class('_publish_request')
+        rq = mock.MagicMock()
+        self.requires_class._send_request(rq)
+        self._publish_request.assert_called_once_with(rq)
+        self.assertEqual(
+            self.requires_class.metrics_summary()['calls']['send_request'][
+                'count'], 1)
+        summary = self.requires_class.metrics_summary()
+        self.requires_class.log_metrics(level='INFO')
+        self.log.assert_called_once_with(
+            'ceph-rbd-mirror metrics: {}'.format(
+                json.dumps(summary, sort_keys=True)),
+            level='INFO')
+        with mock.patch.object(requires, 'open', mock.mock_open(),
+                               create=True) as mocked_open:
+            self.requires_class.dump_metrics('/tmp/metrics.json')
+        mocked_open.assert_called_once_with('/tmp/metrics.json', 'a')
+        mocked_open().write.assert_called_once_with(
+            json.dumps(summary, sort_keys=True) + '\n')
+
+    def test_hook_metrics(self):
+        metrics = requires.HookMetrics()
+        self.assertEqual(metrics.call('double', lambda x: x * 2, 21), 42)
+        with self.assertRaises(ZeroDivisionError):
+            metrics.call('divide', lambda x: x / 0, 1)
+        summary = metrics.summary()
+        self.assertEqual(list(summary.keys()), ['divide', 'double'])
+        self.assertEqual(summary['double']['count'], 1)
+        self.assertGreaterEqual(summary['double']['seconds'], 0)
+
+    def test_batch_publish(self):
+        self.patch_requires_class('_relations')
+        relation = mock.MagicMock()
+        relation.relation_id = 'some-endpoint:42'
+        relation.to_publish_raw = {}
+        self._relations.__iter__.return_value = [relation]
+        self.patch_requires_class('_read_previous_request')
+        self.patch_requires_class('_publish_request')
+        db = mock.MagicMock()
+        db.get.return_value = {}
+        self.patch_object(requires.ch_unitdata, 'kv', return_value=db)
+        previous_rq = mock.MagicMock()
+        previous_rq.ops = []
+        previous_rq.add_op_create_replicated_pool.side_effect = (
+            lambda **kwargs: previous_rq.ops.append(
+                {'op': 'create-pool', 'name': kwargs['name']}))
+        self._read_previous_request.return_value = previous_rq
+        self.patch_object(requires.ch_ceph, 'CephBrokerRq',
+                          return_value=mock.MagicMock())
+        rq = mock.MagicMock()
+        rq.ops = [{'op': 'create-pool', 'name': 'images'}]
+        with self.requires_class.batch_publish():
+            self.requires_class.create_pools([{'name': 'rbd'}])
+            with self.requires_class.batch_publish():
+                self.requires_class.maybe_send_rq(rq)
+            self.assertFalse(self._publish_request.called)
+        self._publish_request.assert_called_once_with(
+            self.CephBrokerRq.return_value)
+        self._publish_request.reset_mock()
+        with self.assertRaises(RuntimeError):
+            with self.requires_class.batch_publish():
+                self.requires_class.create_pools([{'name': 'other'}])
+                raise RuntimeError()
+        self.assertFalse(self._publish_request.called)
+
+    def test_batch_publish_failed(self):
+
+        class FakeRq(object):
+
+            def __init__(self, raw_request_data=None):
+                self.ops = []
+                if raw_request_data:
+                    self.ops = json.loads(raw_request_data)['ops']
+
+            @property
+            def request(self):
+                return json.dumps({'ops': self.ops})
+
+            def add_op_create_replicated_pool(self, name, **kwargs):
+                self.ops.append({'op': 'create-pool', 'name': name})
+
+        self.patch_requires_class('_relations')
+        relation = mock.MagicMock()
+        relation.relation_id = 'some-endpoint:42'
+        relation.to_publish_raw = {}
+        self._relations.__iter__.return_value = [relation]
+        self.patch_requires_class('_read_previous_request')
+        self.patch_requires_class('_publish_request')
+        self._read_previous_request.return_value = FakeRq(
+            json.dumps({'ops': [{'op': 'create-pool', 'name': 'rbd'}]}))
+        self.patch_object(requires.ch_ceph, 'CephBrokerRq', side_effect=FakeRq)
+        db = mock.MagicMock()
+        db.get.return_value = {}
+        self.patch_object(requires.ch_unitdata, 'kv', return_value=db)
+        rq = FakeRq(json.dumps({'ops': [{'op': 'create-pool',
+                                         'name': 'images'}]}))
+        self.requires_class._previous_request('some-endpoint:42')
+        with self.assertRaises(RuntimeError):
+            with self.requires_class.batch_publish():
+                self.requires_class.create_pools([{'name': 'other'}])
+                self.requires_class.maybe_send_rq(rq)
+                raise RuntimeError()
+        self.assertFalse(self._publish_request.called)
+        self.assertFalse(db.set.called)
+        # nothing of the failed batch is remembered as sent
+        self.assertEqual(
+            self.requires_class._previous_request('some-endpoint:42').ops,
+            [{'op': 'create-pool', 'name': 'rbd'}])
+        self.requires_class.create_pools([{'name': 'other'}])
+        self.requires_class.maybe_send_rq(rq)
+        self.assertEqual(self._publish_request.call_count, 2)
+        db.set.assert_called_once_with(
+            'ceph-rbd-mirror.some-endpoint.sent_digests',
+            {'some-endpoint:42': [mock.ANY, mock.ANY]})
+
+    def test_publish_unchanged(self):
+        relation = mock.MagicMock()
+        relation.to_publish_raw = {'unique_id': '"some-hostname"'}
+        self.requires_class._publish(relation, 'unique_id', 'some-hostname')
+        self.assertFalse(relation.to_publish.__setitem__.called)
+        self.requires_class._publish(relation, 'unique_id', 'other')
+        relation.to_publish.__setitem__.assert_called_once_with(
+            'unique_id', 'other')
+
+    def test_compact_encoding(self):
+        encoded = requires._encode_compact({'ops': [], 'request-id': 'a'})
+        self.assertTrue(encoded.startswith('zlib+b64:'))
+        self.assertEqual(json.loads(requires._unpack(encoded)),
+                         {'ops': [], 'request-id': 'a'})
+        self.assertEqual(requires._unpack('{"ops": []}'), '{"ops": []}')
+
+    def test_broker_requests_compact(self):
+        self.patch_requires_class('_all_joined_units')
+        self._all_joined_units.received.__contains__.return_value = True
+        self._all_joined_units.received.__getitem__.return_value = (
+            requires._encode_compact([
+                json.dumps({'request-id': 'a', 'ops': []}),
+                requires._encode_compact({'request-id': 'b', 'ops': []}),
+            ]))
+        self.assertEqual(list(self.requires_class.broker_requests), [
+            {'request-id': 'a', 'ops': []},
+            {'request-id': 'b', 'ops': []},
+        ])
+
+    def test_enable_compact_encoding(self):
+
+        class FakeRq(object):
+
+            def __init__(self, ops):
+                self.ops = ops
+                self.request = json.dumps({'ops': ops})
+
+            def __eq__(self, other):
+                return self.ops == other.ops
+
+        self.patch_requires_class('_relations')
+        relation = mock.MagicMock()
+        relation.relation_id = 'some-endpoint:42'
+        relation.to_publish_raw = {}
+        unit = mock.MagicMock()
+        unit.received = {'broker-encodings': ['zlib+b64']}
+        relation.units = [unit]
+        self._relations.__iter__.return_value = [relation]
+        self.patch_object(requires.ch_ceph, 'CephBrokerRq')
+        self.CephBrokerRq.side_effect = lambda raw_request_data: FakeRq(
+            json.loads(raw_request_data)['ops'])
+        self.patch_object(requires.ch_hookenv, 'local_unit')
+        self.local_unit.return_value = 'ceph-rbd-mirror/0'
+        self.requires_class.enable_compact_encoding()
+        relation.to_publish.__setitem__.assert_called_once_with(
+            'broker-encodings', ['zlib+b64'])
+        rq = FakeRq([{'op': 'create-pool', 'name': 'rbd'}])
+        self.requires_class._send_request(rq)
+        raw = relation.to_publish_raw['broker_req']
+        self.assertTrue(raw.startswith('zlib+b64:'))
+        self.assertEqual(json.loads(requires._unpack(raw)), {'ops': rq.ops})
+        # the unit name is written raw, not JSON encoded
+        self.assertEqual(relation.to_publish_raw['unit-name'],
+                         'ceph-rbd-mirror/0')
+        # an equivalent request is not sent again
+        written = dict(relation.to_publish_raw)
+        self.requires_class._send_request(FakeRq(list(rq.ops)))
+        self.assertEqual(relation.to_publish_raw, written)
+        # plain JSON is sent to peers without support for compact encoding
+        unit.received = {'broker-encodings': None}
+        rq = FakeRq([{'op': 'create-pool', 'name': 'images'}])
+        self.requires_class._send_request(rq)
+        self.assertEqual(relation.to_publish_raw['broker_req'], rq.request)
+
+    def test_chunk_ops(self):
+        ops = [{'op': 'create-pool', 'name': 'pool-{}'.format(i)}
+               for i in range(1000)]
+        chunks = requires._chunk_ops(ops)
+        self.assertEqual(
+            [op for _, chunk in chunks for op in chunk], ops)
+        self.assertTrue(all(len(chunk) <= requires.CHUNK_MAX_OPS
+                            for _, chunk in chunks))
+        self.assertEqual(requires._chunk_ops(list(ops)), chunks)
+        # adding an op only changes the chunk holding it
+        ops.insert(500, {'op': 'create-pool', 'name': 'new'})
+        self.assertEqual(
+            len(set(dict(requires._chunk_ops(ops))) - set(dict(chunks))), 1)
+        self.assertEqual(requires._chunk_ops([]), [])
+
+    def test_enable_chunked_requests(self):
+        self.patch_requires_class('_relations')
+        relation = mock.MagicMock()
+        relation.relation_id = 'some-endpoint:42'
+        relation.to_publish_raw = {}
+        unit = mock.MagicMock()
+        unit.received = {'broker-features': ['broker-req-chunks']}
+        relation.units = [unit]
+        self._relations.__iter__.return_value = [relation]
+        self._relations.__getitem__.return_value = relation
+        self.patch_object(requires.ch_hookenv, 'local_unit')
+        self.local_unit.return_value = 'ceph-rbd-mirror/0'
+        self.requires_class.enable_chunked_requests()
+        relation.to_publish.__setitem__.assert_called_once_with(
+            'broker-features', ['broker-req-chunks'])
+        rq = mock.MagicMock()
+        rq.api_version = 1
+        rq.request_id = 'some-id'
+        rq.ops = [{'op': 'create-pool', 'name': 'pool-{}'.format(i)}
+                  for i in range(200)]
+        self.requires_class._send_request(rq)
+        manifest = json.loads(relation.to_publish_raw['broker_req_chunks'])
+        self.assertEqual(manifest['chunks'],
+                         [chunk_id for chunk_id, _ in
+                          requires._chunk_ops(rq.ops)])
+        self.assertNotIn('broker_req', relation.to_publish_raw)
+        # the request is read back from the chunks
+        self.patch_object(requires.ch_ceph, 'CephBrokerRq')
+        self.requires_class._previous_request('some-endpoint:42')
+        raw = json.loads(
+            self.CephBrokerRq.call_args_list[0][1]['raw_request_data'])
+        self.assertEqual(raw, {'api-version': 1, 'request-id': 'some-id',
+                               'ops': rq.ops})
+        # only changed chunks are rewritten and stale chunks are removed
+        written = {}
+        relation.to_publish_raw = mock.MagicMock()
+        relation.to_publish_raw.get.side_effect = written.get
+        relation.to_publish_raw.__getitem__.side_effect = written.__getitem__
+        relation.to_publish_raw.__setitem__.side_effect = written.__setitem__
+        written['broker_req_chunks'] = json.dumps(manifest)
+        rq.ops = rq.ops[:100] + rq.ops[101:]
+        self.requires_class._send_request(rq)
+        new = json.loads(written['broker_req_chunks'])['chunks']
+        self.assertEqual(len(set(new) - set(manifest['chunks'])), 1)
+        self.assertEqual(
+            [key for key, value in written.items() if value is None],
+            ['broker_req_chunk.' + chunk_id
+             for chunk_id in set(manifest['chunks']) - set(new)])
+        relation.to_publish_raw.__setitem__.reset_mock()
+        self.requires_class._send_request(rq)
+        self.assertFalse(relation.to_publish_raw.__setitem__.called)
+        # a request published whole is removed when switching to chunks
+        written['broker_req'] = rq.request
+        self.requires_class._send_request(rq)
+        relation.to_publish_raw.__setitem__.assert_called_once_with(
+            'broker_req', None)
+        # and chunks are removed when falling back to a whole request
+        self.requires_class._chunked_requests = False
+        rq.request = json.dumps({'api-version': 1, 'ops': rq.ops})
+        self.requires_class._send_request(rq)
+        self.assertEqual(written['broker_req'], rq.request)
+        self.assertEqual(
+            sorted(key for key, value in written.items() if value is None),
+            sorted(['broker_req_chunks'] + [
+                'broker_req_chunk.' + chunk_id
+                for chunk_id in set(manifest['chunks']) | set(new)]))
+
+    def test_fan_out_broker_requests(self):
+        op_a = {'op': 'create-pool', 'name': 'a'}
+        op_b = {'op': 'create-pool', 'name': 'b'}
+        source = mock.MagicMock()
+        source.broker_requests = [
+            {'request-id': '1', 'ops': [op_a, {'op': 'set-key-permissions'}]},
+            {'request-id': '2', 'ops': [op_b, dict(op_a)]},
+            {'request-id': '3'},
+        ]
+        targets = [mock.MagicMock(), mock.MagicMock()]
+        self.patch_object(requires.ch_ceph, 'CephBrokerRq',
+                          return_value=mock.MagicMock(ops=[]))
+        rq = mock.MagicMock()
+        self.CephBrokerRq.return_value = rq
+        ops = requires.fan_out_broker_requests(source, targets)
+        self.assertEqual(ops, [op_a, op_b])
+        for target in targets:
+            target.batch_publish.assert_called_once_with()
+        # the index of operations is built by the first target needing it
+        targets[0]._maybe_send_ops.assert_called_once_with(
+            ops, requires._ops_digest(ops), mock.ANY, None)
+        targets[1]._maybe_send_ops.assert_called_once_with(
+            ops, requires._ops_digest(ops), mock.ANY,
+            targets[0]._maybe_send_ops.return_value)
+        get_rq = targets[0]._maybe_send_ops.call_args[0][2]
+        self.assertIs(get_rq(), rq)
+        rq.set_ops.assert_called_once_with(ops)
+        self.assertIsNot(rq.set_ops.call_args[0][0], ops)
+        ops = requires.fan_out_broker_requests(
+            source, targets, op_filter=lambda op: op.get('name') == 'b')
+        self.assertEqual(ops, [op_b])
+
+    def test_maybe_send_ops(self):
+        self.patch_requires_class('_relations')
+        relation = mock.MagicMock()
+        relation.relation_id = 'some-endpoint:42'
+        relation.to_publish_raw = {'broker_req': '{"ops": []}'}
+        self._relations.__iter__.return_value = [relation]
+        self.patch_requires_class('_send_request')
+        marker = self.requires_class._published_marker(relation)
+        db = mock.MagicMock()
+        db.get.return_value = {'some-endpoint:42': ['digest', marker]}
+        self.patch_object(requires.ch_unitdata, 'kv', return_value=db)
+        get_rq = mock.MagicMock()
+        self.requires_class._maybe_send_ops([], 'digest', get_rq)
+        self.assertFalse(get_rq.called)
+        self.assertFalse(self._send_request.called)
+        # a digest recorded without a marker is not trusted
+        db.get.return_value = {'some-endpoint:42': 'digest'}
+        self.requires_class._sent_digests = None
+        self.patch_requires_class('_previous_request')
+        self.requires_class._maybe_send_ops([], 'digest', get_rq)
+        self._send_request.assert_called_once_with(get_rq.return_value)
+
+    def test_resolve_hostnames(self):
+        slow = requires.threading.Event()
+        self.addCleanup(slow.set)
+
+        def resolve_hostname(host):
+            if host == 'slow':
+                slow.wait()
+            return {'mon0': '192.0.2.1'}.get(host)
+
+        self.patch_object(requires, '_resolve_hostname',
+                          side_effect=resolve_hostname)
+        timeout = mock.patch.object(requires, 'RESOLVE_TIMEOUT', 0.2)
+        timeout.start()
+        self.addCleanup(timeout.stop)
+        self.assertEqual(
+            requires._resolve_hostnames(['mon0', 'slow', 'unknown']),
+            {'mon0': '192.0.2.1', 'unknown': None})
+        # the deadline is shared by all lookups in the hook
+        self.assertEqual(requires._resolve_hostnames(['mon0']), {})
+
+    def test_reset_hook_state(self):
+        requires._network_cidrs['192.0.2.1'] = '192.0.2.0/24'
+        requires._resolved_hosts['mon0'] = '192.0.2.1'
+        requires._resolve_deadline = 42
+        self.patch_object(requires, '_hostname')
+        requires._hostname = 'juju-1a2b3c-0'
+        requires._reset_hook_state()
+        self.assertEqual(requires._network_cidrs, {})
+        self.assertEqual(requires._resolved_hosts, {})
+        self.assertIsNone(requires._resolve_deadline)
+        self.assertIsNone(requires._hostname)
+
+    def test_resolve_hostname(self):
+        self.patch_object(requires.socket, 'getaddrinfo')
+        self.getaddrinfo.return_value = [
+            (None, None, None, '', ('fe80::1%eth0', 0, 0, 2))]
+        self.assertEqual(requires._resolve_hostname('mon0'), 'fe80::1')
+        self.getaddrinfo.side_effect = requires.socket.gaierror()
+        self.assertEqual(requires._resolve_hostname('mon0'), None)
+
+    def test_mon_hosts_hostnames(self):
+        self.patch_requires_class('_relations')
+        relation = mock.MagicMock()
+        unit0 = mock.MagicMock()
+        unit0.received = {'ceph-public-address': 'mon0.example.com',
+                          'ceph-cluster-address': '198.51.100.1'}
+        unit1 = mock.MagicMock()
+        unit1.received = {'ceph-public-address': 'mon1.example.com',
+                          'ceph-cluster-address': 'mon1-cluster'}
+        unit2 = mock.MagicMock()
+        unit2.received = {'ceph-public-address': 'not a hostname'}
+        relation.units = [unit0, unit1, unit2]
+        self._relations.__iter__.return_value = [relation]
+        db = mock.MagicMock()
+        db.get.return_value = {
+            'mon0.example.com': {'addr': '192.0.2.1', 'expires': 200},
+            'mon1.example.com': {'addr': '192.0.2.9', 'expires': 50},
+        }
+        self.patch_object(requires.ch_unitdata, 'kv', return_value=db)
+        self.patch_object(requires.time, 'time', return_value=100)
+        self.patch_object(requires, '_resolve_hostnames')
+        self._resolve_hostnames.return_value = {
+            'mon1.example.com': '192.0.2.2'}
+        self.assertEqual(list(self.requires_class.mon_hosts()),
+                         ['192.0.2.1:6789', '192.0.2.2:6789'])
+        # all advertised hostnames without a valid cached result are
+        # resolved at once
+        self._resolve_hostnames.assert_called_once_with(
+            ['mon1-cluster', 'mon1.example.com'])
+        db.set.assert_called_once_with(
+            'ceph-rbd-mirror.some-endpoint.resolved_hosts', {
+                'mon0.example.com': {'addr': '192.0.2.1', 'expires': 200},
+                'mon1.example.com': {'addr': '192.0.2.2', 'expires': 400},
+            })
+        # results are shared for the rest of the hook
+        self.patch_requires_class('_all_joined_units')
+        self._all_joined_units.received.__getitem__.return_value = (
+            'mon1-cluster')
+        self.assertEqual(self.requires_class.cluster_network, None)
+        self._resolve_hostnames.assert_called_once_with(
+            ['mon1-cluster', 'mon1.example.com'])
+
+    def test_read_previous_request(self):
+        self.patch_requires_class('_relations')
+        relation = mock.MagicMock()
+        self._relations.__getitem__.return_value = relation
+        self.patch_object(requires.ch_ceph, 'CephBrokerRq')
+        request = json.dumps({'api-version': 1, 'request-id': 'a',
+                              'ops': [{'op': 'create-pool', 'name': 'rbd'}]})
+        relation.to_publish_raw = {}
+        self.assertIsNone(
+            self.requires_class._read_previous_request('some-endpoint:42'))
+        self._relations.__getitem__.assert_called_once_with(
+            'some-endpoint:42')
+        relation.to_publish_raw = {'broker_req': request}
+        self.requires_class._read_previous_request('some-endpoint:42')
+        self.CephBrokerRq.assert_called_once_with(raw_request_data=request)
+        # compact encoded requests are read without compact encoding enabled
+        self.CephBrokerRq.reset_mock()
+        relation.to_publish_raw = {
+            'broker_req': requires._encode_compact(json.loads(request))}
+        self.requires_class._read_previous_request('some-endpoint:42')
+        self.assertEqual(
+            json.loads(self.CephBrokerRq.call_args[1]['raw_request_data']),
+            json.loads(request))